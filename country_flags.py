@@ -15,11 +15,28 @@ https://github.com/coolcornucopia/
 #   https://en.wikipedia.org/wiki/List_of_aspect_ratios_of_national_flags
 #   https://en.wikipedia.org/wiki/List_of_ISO_3166_country_codes
 
-from turtle import Turtle, Screen, Shape, mainloop
+# Note: the turtle module (and then Tk) is imported only when drawing on the
+# screen, so this module can be imported quickly & without display (for
+# flags metadata, headless exports...).
 import math
+import contextlib
+from array import array
+import collections
 import locale
 import unicodedata # Use to sort strings with accents, see strip_accents()
 import time
+import os
+import json
+import argparse
+import bisect
+import subprocess
+import hashlib
+import atexit
+import sys
+import struct
+import zlib
+import threading
+import mmap
 
 
 ### CONFIGURATION ###
@@ -29,13 +46,29 @@ MOUSE_BUTTON_EXIT = 2   # mouse buttons: 1 left, 2 center, 3 right
 MOUSE_BUTTON_NORMAL = 1
 
 COUNTRY_NAMES_FILENAME = "country_names"
+COUNTRY_CODES_FILENAME = "country_codes"  # ISO 3166 numeric & alpha codes
+# Parsed country names of all the languages with their sort keys (the cache
+# is rebuilt when a country_names.<language> file is modified)
+COUNTRY_NAMES_CACHE_FILENAME = "country_names.cache"
 DEFAULT_LANGUAGE = "en"
 
 DEFAULT_FAST_DRAW = True
 DEFAULT_ANIMATION_SPEED = 3 # Only possible if DEFAULT_FAST_DRAW is False
-
-DEFAULT_SCREENSHOT_ANIM_SPEED = DEFAULT_ANIMATION_SPEED
+# Fast draw backend: "canvas" creates the Tk canvas items directly (fastest),
+# "turtle" replays the flag shapes with the turtle (the animated mode always
+# uses the turtle)
+DEFAULT_DRAW_BACKEND = "canvas"
+
+# Long drawings are done by chunks from the event loop: max duration of a
+# chunk (seconds) and delay between chunks (milliseconds) to handle events
+RENDER_FRAME_BUDGET = 0.03
+RENDER_CHUNK_DELAY = 1
+
+# Animated screenshots: one frame every N drawn shapes, the last frame is
+# shown longer (in seconds)
+DEFAULT_SCREENSHOT_ANIM_SHAPES = 1
 DEFAULT_SCREENSHOT_ANIM_FPS = 20
+DEFAULT_SCREENSHOT_ANIM_END = 3
 
 # Create a black & white "always visible" turtle shape.
 # This is usefull when both fill & pen colors are
@@ -44,30 +77,178 @@ DEFAULT_SCREENSHOT_ANIM_FPS = 20
 USE_ALWAYS_VISIBLE_TURTLE_SHAPE = True
 
 FLAG_BORDER_COL = 'black'
+LABEL_FONT = ("Arial", 11, "normal")  # country names font
 FLAG_DEFAULT_RATIO = 2/3  # preferred flag ratio size between width & height
 
 FULLSCREEN = True
 
+# In fast mode, repeated motifs (stars, spokes...) are stamped with
+# registered Turtle shapes instead of being drawn segment by segment
+USE_STAMPS = True
+
+GEOMETRY_CACHE_SIZE = 16  # compiled flags kept in memory, per flag
+COMPILE_MIN_WIDTH = 16  # smallest width used to compile flags in unit space
+# Compiled flags of the exported sizes saved on disk for the next processes
+# (see --build-cache)
+COMPILED_CACHE_FILENAME = "compiled_flags.cache"
+
+# Flag pages layout: "grid" (same width for all the flags) or "justified"
+# (same height in a row, the rows fill the window width)
+DEFAULT_LAYOUT_STRATEGY = "grid"
+LAYOUT_LABEL_HEIGHT = 18  # room for the country names (above the flags)
+LAYOUT_CACHE_SIZE = 32
+
+# Gallery modes (see --mode): "pages" shows the flags page by page (arrow
+# keys, page up/down...), "scroll" shows two strips of small flags scrolling
+# on the top & bottom of the window with the big flag in the center
+GALLERY_PAGES_KEPT = 1  # pages kept drawn (hidden) around the current one
+SCROLL_FPS = 30
+SCROLL_SPEED = 60  # pixels per second
+
+# Delay (milliseconds) after the last window resize event before moving &
+# scaling the flags to the new layout
+RESIZE_DELAY = 100
+
+# Circles & arcs are drawn with a number of segments depending on their
+# on-screen radius: the max distance (in pixels) between the exact circle
+# and its segments is CIRCLE_TOLERANCE
+CIRCLE_TOLERANCE = 0.3
+CIRCLE_MIN_STEPS = 4   # for a full circle
+CIRCLE_MAX_STEPS = 360 # for a full circle
+
+# Levels of detail: small flags are drawn with simplified geometries
+LOD_REDUCED_WIDTH = 200  # below this width, tiny details are dropped
+LOD_SWATCH_WIDTH = 48    # below this width, flags are drawn as color blocks
+LOD_MIN_DETAIL = 1.5     # shapes smaller than this (in pixels) are tiny
+LOD_MAX_ERROR = 0.035    # max mean color difference with the full drawing
+
+# Remove the hidden shapes & merge the same color shapes of compiled flags
+OPTIMIZE_SHAPES = True
+USE_NUMPY = True  # Use numpy (if installed) for geometry transforms
+
+# Batch export (see batch_export() & the --export command line option)
+DEFAULT_EXPORT_SIZES = [32, 64, 128, 160, 256, 416]  # flag widths in pixels
+DEFAULT_EXPORT_FORMATS = ['png']
+
+# Sprite atlases (see build_atlas() & the --atlas command line option): all
+# the flags at several widths packed in a few png images
+DEFAULT_ATLAS_SIZES = [32, 64, 128]  # flag widths in pixels
+ATLAS_MAX_SIZE = 2048  # max atlas width & height in pixels
+ATLAS_PADDING = 1  # pixels between the sprites (no bleeding when scaled)
+ATLAS_INDEX_FILENAME = "atlas.json"
+
+# Vector exports (svg files, pdf & postscript catalogues): flags are
+# recorded at least at this width, so circles stay smooth when zoomed
+VECTOR_RECORD_WIDTH = 1024
+CATALOGUE_PAGE_SIZE = (595, 842)  # A4 in points (1/72 inch)
+CATALOGUE_MARGIN = 56  # points
+CATALOGUE_FONT_SIZE = 14  # country names font size in points
+
+# Flags http service (see --serve): /flag/<code>.<png|svg>?w=<width>
+SERVE_ADDRESS = "127.0.0.1"
+SERVE_PORT = 8000
+SERVE_DEFAULT_WIDTH = 160
+SERVE_MAX_WIDTH = 2048
+SERVE_CACHE_SIZE = 1024  # rendered images kept in memory
+SERVE_LATENCIES_KEPT = 10000  # latest request durations for the stats
+
+DEFAULT_BENCHMARK_SIZES = [32, 160, 416]
+DEFAULT_BENCHMARK_REPEAT = 3  # the best time of the runs is kept
+EXPORT_MANIFEST_FILENAME = "manifest.json"
+
 DEBUG = False
 #DEBUG = True
 
 
 ### GLOBAL VARIABLES ###
 
-# This is our "current turtle (ct)"
-ct = Turtle()
+# The Turtle & the Screen are only created when they are used for the first
+# time, so recording & headless rendering (PNG export...) do not need any
+# display.
+class LazyObject(object):
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def instance(self):
+        if self._target is None:
+            self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.instance(), name)
 
 # TODO (resolution, default white background)
-screen = Screen()
-if FULLSCREEN:
-    screen.setup(width = 0.80, height = 0.80)
+def create_screen():
+    from turtle import Screen
+    s = Screen()
+    if FULLSCREEN:
+        s.setup(width = 0.80, height = 0.80)
+    return s
+
+def create_turtle():
+    from turtle import Turtle
+    screen.instance() # Be sure the screen is configured first
+    return Turtle()
+
+screen = LazyObject(create_screen)
+
+# A render context is the target of the drawings (the screen turtle, a
+# Recorder, a RasterTarget...) with its drawing options (None for the
+# global fast_draw & draw_backend defaults, see update_configure()).
+# Contexts are per thread, so several renders can be done at the same time
+# in several threads (with headless targets only, Tk is not thread safe).
+class RenderContext(object):
+    def __init__(self, target, fast=None, backend=None):
+        self.target = target
+        self.fast_draw = fast
+        self.backend = backend
+
+default_context = RenderContext(LazyObject(create_turtle))
+thread_contexts = threading.local()  # stack of the contexts of a thread
+
+def current_context():
+    stack = getattr(thread_contexts, 'stack', None)
+    return stack[-1] if stack else default_context
+
+@contextlib.contextmanager
+def render_context(context):
+    stack = getattr(thread_contexts, 'stack', None)
+    if stack is None:
+        stack = thread_contexts.stack = []
+    stack.append(context)
+    try:
+        yield context
+    finally:
+        stack.pop()
+
+def context_fast_draw():
+    fast = current_context().fast_draw
+    return fast_draw if fast is None else fast
+
+def context_backend():
+    return current_context().backend or draw_backend
+
+# The target of the current render context of the current thread
+class CurrentTurtle(object):
+    def instance(self):
+        target = current_context().target
+        return target.instance() if isinstance(target, LazyObject) else target
+
+    def __getattr__(self, name):
+        return getattr(current_context().target, name)
+
+# This is our "current turtle (ct)"
+ct = CurrentTurtle()
 
 my_screenclicked = False
 my_keypressed = False
 
+# Drawing options of the render contexts which do not set them
 fast_draw = False
+draw_backend = DEFAULT_DRAW_BACKEND
 
-country_names = {}  # Content depends on the language
+country_names = {}  # Content depends on the language, see load_country_names
 
 
 ### DRAWING PRIMITIVES ###
@@ -106,12 +287,26 @@ def square(x, y, width, rotation=0):
 def square_filled(x, y, width, rotation=0):
     rectangle_filled(x, y, width, width, rotation)
 
+# Number of segments for a circle arc of "extent" degrees, so that the
+# segments are never further than CIRCLE_TOLERANCE from the exact arc
+# (small circles get less segments than big ones)
+def circle_steps(radius, extent=360):
+    radius = abs(radius)
+    if radius <= CIRCLE_TOLERANCE:
+        angle = math.pi
+    else:
+        angle = 2 * math.acos(1 - CIRCLE_TOLERANCE / radius)
+    steps = math.ceil(math.radians(abs(extent)) / angle)
+    frac = abs(extent) / 360
+    return max(1, int(math.ceil(CIRCLE_MIN_STEPS * frac)),
+               min(steps, int(math.ceil(CIRCLE_MAX_STEPS * frac))))
+
 # For the circle, use the diameter instead of the radius because it is
 # then easier to make objects touch themselves, avoiding x2 in user code.
 def circle(center_x, center_y, diameter):
     # Move the circle center following Turtle circle() usage
     prepare_drawing(center_x, center_y - diameter / 2)
-    ct.circle(diameter / 2)
+    ct.circle(diameter / 2, 360, circle_steps(diameter / 2))
 
 def circle_filled(center_x, center_y, diameter):
     ct.begin_fill()
@@ -196,13 +391,14 @@ def pie(center_x, center_y, diameter, start, end):
     # Move the turtle at the start position with the start angle
     # and save this start position
     ct.penup()
-    ct.circle(diameter / 2, start)
+    ct.circle(diameter / 2, start, circle_steps(diameter / 2, start))
     x, y = ct.pos()
     # Restore the filling context is necessary and draw the circle arc
     ct.pendown()
     if filling:
         ct.begin_fill()
-    ct.circle(diameter / 2, end - start)
+    ct.circle(diameter / 2, end - start,
+              circle_steps(diameter / 2, end - start))
     # Close the pie slice
     ct.goto(center_x, center_y) # Go to the pie slice center
     ct.goto(x, y)               # Go to the start position
@@ -289,6 +485,719 @@ def circle_coord(center_x, center_y, radius, angle_pc):
     return x, y
 
 
+### DISPLAY LIST RECORDING ###
+
+# A display list is the list of the filled shapes of a drawing, in painting
+# order. Each shape is a FilledPolygon: a fill color and the polygon
+# vertices in Turtle coordinates. Display lists are produced by a Recorder
+# and consumed by replay backends (see draw_display_list()).
+# The anchor (x, y, heading) is the pen position & heading when the shape
+# drawing started, so identical shapes (stars...) have identical points
+# relative to their anchor, whatever their position & rotation.
+class FilledPolygon(object):
+    __slots__ = ('color', 'points', 'anchor')
+
+    def __init__(self, color, points, anchor=None):
+        self.color = color
+        self.points = points
+        if anchor is None:
+            anchor = points[0] + (0,)
+        self.anchor = anchor
+
+    def __repr__(self):
+        return "FilledPolygon(%r, %d points)" % (self.color, len(self.points))
+
+# The Recorder mimics the subset of the Turtle API used by the drawing
+# primitives & flag functions. Instead of drawing, it only keeps track of
+# the pen position & heading and records every filled shape. Geometry is
+# computed exactly like Turtle does (circle() steps included) so a replayed
+# display list looks the same as a direct drawing.
+class Recorder(object):
+    def __init__(self):
+        self.items = []
+        self._x = 0.0
+        self._y = 0.0
+        self._heading = 0.0
+        self._drawing = True
+        self._pencolor = 'black'
+        self._fillcolor = 'black'
+        self._fillpath = None
+        self._fillheading = 0
+
+    # Pen state
+    def penup(self):
+        self._drawing = False
+    pu = up = penup
+
+    def pendown(self):
+        self._drawing = True
+    pd = down = pendown
+
+    def isdown(self):
+        return self._drawing
+
+    # Colors, same conventions as Turtle color(), pencolor() & fillcolor()
+    def color(self, *args):
+        if not args:
+            return self._pencolor, self._fillcolor
+        if len(args) == 1:
+            self._pencolor = self._fillcolor = args[0]
+        else:
+            self._pencolor, self._fillcolor = args[0], args[1]
+        return None
+
+    def pencolor(self, *args):
+        if not args:
+            return self._pencolor
+        self._pencolor = args[0]
+        return None
+
+    def fillcolor(self, *args):
+        if not args:
+            return self._fillcolor
+        self._fillcolor = args[0]
+        return None
+
+    # Position & heading
+    def pos(self):
+        return self._x, self._y
+    position = pos
+
+    def xcor(self):
+        return self._x
+
+    def ycor(self):
+        return self._y
+
+    def heading(self):
+        return self._heading
+
+    def setheading(self, angle):
+        self._heading = angle % 360
+    seth = setheading
+
+    def left(self, angle):
+        self.setheading(self._heading + angle)
+    lt = left
+
+    def right(self, angle):
+        self.setheading(self._heading - angle)
+    rt = right
+
+    def goto(self, x, y=None):
+        if y is None:
+            x, y = x
+        if self._fillpath is not None:
+            # Ignore the pen up moves done before the first drawn segment
+            # (prepare_drawing() moves the pen after begin_fill())
+            if not self._drawing and len(self._fillpath) == 1:
+                self._fillpath[0] = (x, y)
+            else:
+                if len(self._fillpath) == 1:
+                    self._fillheading = self._heading
+                self._fillpath.append((x, y))
+        self._x, self._y = x, y
+    setpos = setposition = goto
+
+    def forward(self, distance):
+        angle = math.radians(self._heading)
+        self.goto(self._x + distance * math.cos(angle),
+                  self._y + distance * math.sin(angle))
+    fd = forward
+
+    def backward(self, distance):
+        self.forward(-distance)
+    back = bk = backward
+
+    # Same algorithm as Turtle circle(), see turtle.py
+    def circle(self, radius, extent=None, steps=None):
+        if extent is None:
+            extent = 360
+        if steps is None:
+            frac = abs(extent) / 360
+            steps = 1 + int(min(11 + abs(radius) / 6.0, 59.0) * frac)
+        w = 1.0 * extent / steps
+        w2 = 0.5 * w
+        l = 2.0 * radius * math.sin(math.radians(w2))
+        if radius < 0:
+            l, w, w2 = -l, -w, -w2
+        self.left(w2)
+        for _ in range(steps):
+            self.forward(l)
+            self.left(w)
+        self.left(-w2)
+
+    # Filling
+    def filling(self):
+        return self._fillpath is not None
+
+    def begin_fill(self):
+        self._fillpath = [(self._x, self._y)]
+
+    def end_fill(self):
+        if self._fillpath is not None and len(self._fillpath) > 2:
+            self.items.append(FilledPolygon(self._fillcolor,
+                                            tuple(self._fillpath),
+                                            self._fillpath[0] +
+                                            (self._fillheading,)))
+        self._fillpath = None
+
+    # Turtle methods without any effect on the display list
+    def speed(self, speed=None):
+        return 0
+
+    def pensize(self, width=None):
+        return 1
+
+    def write(self, *args, **kwargs):
+        pass
+
+    def hideturtle(self):
+        pass
+    ht = hideturtle
+
+    def showturtle(self):
+        pass
+    st = showturtle
+
+    def clear(self):
+        self.items = []
+
+# Recording mode: all drawings done inside the "with" block go to the
+# returned Recorder instead of the screen, for instance:
+#   with recording() as rec:
+#       flag_India(0, 0, 300, 200)
+#   print(rec.items)
+@contextlib.contextmanager
+def recording():
+    with using_turtle(Recorder()) as rec:
+        yield rec
+
+# Use temporarily another turtle (or a Recorder...) as current turtle of
+# the current thread
+@contextlib.contextmanager
+def using_turtle(turtle, fast=None, backend=None):
+    with render_context(RenderContext(turtle, fast, backend)):
+        yield turtle
+
+# Count the method calls done on a turtle (or on a Recorder)
+class OperationCounter(object):
+    def __init__(self, target):
+        self.target = target
+        self.counts = collections.Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if not callable(attr):
+            return attr
+        counts = self.counts
+        def counted(*args, **kwargs):
+            counts[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+# Return the Recorder used as current turtle (through counters...) if any
+def current_recorder():
+    target = current_context().target
+    while isinstance(target, OperationCounter):
+        target = target.target
+    return target if isinstance(target, Recorder) else None
+
+# Record a drawing function call and return its display list
+def record(drawing_func, *args):
+    with recording() as rec:
+        drawing_func(*args)
+    return rec.items
+
+# Draw a display list with the selected backend (when recording, the items
+# are simply added to the recorder)
+def draw_display_list(items, backend=None):
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.items.extend(items)
+    elif (backend or context_backend()) == "canvas":
+        draw_display_list_canvas(items)
+    else:
+        draw_display_list_turtle(items)
+
+# Turtle replay backend: draw a display list with the current turtle.
+# In fast mode, the shapes found several times are stamped (see below).
+def draw_display_list_turtle(items):
+    if not (USE_STAMPS and context_fast_draw()):
+        for item in items:
+            ct.color(item.color)
+            polygon_filled(item.points)
+        return
+    keys = [motif_key(item) for item in items]
+    counts = collections.Counter(keys)
+    turtle_shape = ct.shape()
+    for item, key in zip(items, keys):
+        if counts[key] > 1 or key in motif_shapes:
+            stamp_motif(item, key)
+        else:
+            ct.color(item.color)
+            polygon_filled(item.points)
+    ct.shape(turtle_shape)
+
+# Tk canvas backend: one canvas polygon per shape, created directly on the
+# Turtle screen canvas, without any turtle bookkeeping (pen, undo buffer,
+# fill path...). All these items have the CANVAS_ITEMS_TAG tag, see
+# clear_drawings().
+CANVAS_ITEMS_TAG = "flag_shapes"
+
+def tk_color(color):
+    if isinstance(color, tuple):
+        return "#{:02x}{:02x}{:02x}".format(*color_rgb(color))
+    return color
+
+def draw_display_list_canvas(items, tags=()):
+    canvas = screen.getcanvas()
+    # Same conversion as Turtle _drawpoly(): canvas y-axis goes down
+    xscale, yscale = screen.xscale, -screen.yscale
+    tags = (CANVAS_ITEMS_TAG,) + tuple(tags)
+    ids = []
+    for item in items:
+        coords = []
+        for x, y in item.points:
+            coords.append(x * xscale)
+            coords.append(y * yscale)
+        color = tk_color(item.color)
+        ids.append(canvas.create_polygon(coords, fill=color, outline=color,
+                                         width=1, tags=tags))
+    return ids
+
+def canvas_point(x, y):
+    return x * screen.xscale, -y * screen.yscale
+
+# Draw a flag with its border & name as canvas items with the given tags, so
+# they can be moved, scaled, hidden... later (see DrawnPage, PagedGallery)
+def draw_flag_items(flag, x, y, width, height, label=False, tags=()):
+    tags = (CANVAS_ITEMS_TAG,) + tuple(tags)
+    draw_display_list_canvas(flag.record(x, y, width, height), tags)
+    canvas = screen.getcanvas()
+    x0, y0 = canvas_point(x, y)
+    x1, y1 = canvas_point(x + width, y - height)
+    canvas.create_rectangle(x0, y0, x1, y1, outline=FLAG_BORDER_COL,
+                            tags=tags)
+    if label:
+        canvas.create_text((x0 + x1) / 2, y0, anchor="s", font=LABEL_FONT,
+                           text=get_country_name(flag.country_code),
+                           tags=tags)
+
+# Delete the turtle drawings & the canvas backend items
+def clear_drawings():
+    ct.clear()
+    screen.getcanvas().delete(CANVAS_ITEMS_TAG)
+
+
+### SHAPE REGISTRY (STAMPS) ###
+
+# Repeated motifs (United States stars, India chakra spokes & rim circles,
+# South Korea trigram bars...) are registered once as Turtle compound
+# shapes (one per size & color) then each copy is a single stamp() instead
+# of tens of turtle moves.
+
+motif_shapes = {}  # motif key -> registered shape name
+
+# A motif key is the shape color & its points relative to the anchor, in
+# the Turtle shape coordinates: y along the heading, x on the right side
+# (see Turtle _polytrafo()).
+def motif_key(item):
+    ax, ay, heading = item.anchor
+    angle = math.radians(heading)
+    cos_h, sin_h = math.cos(angle), math.sin(angle)
+    points = []
+    for x, y in item.points:
+        dx, dy = x - ax, y - ay
+        along = dx * cos_h + dy * sin_h   # along the heading
+        left = -dx * sin_h + dy * cos_h   # on the left side of the heading
+        points.append((round(-left, 2), round(along, 2)))
+    return item.color, tuple(points)
+
+def register_motif(key):
+    name = motif_shapes.get(key)
+    if name is None:
+        color, points = key
+        name = "motif_{}".format(len(motif_shapes))
+        from turtle import Shape
+        shape = Shape("compound")
+        shape.addcomponent(points, color, color)
+        screen.register_shape(name, shape)
+        motif_shapes[key] = name
+    return name
+
+def stamp_motif(item, key):
+    x, y, heading = item.anchor
+    ct.shape(register_motif(key))
+    ct.penup()
+    ct.goto(x, y)
+    ct.setheading(heading)
+    ct.stamp()
+
+
+### INSTRUMENTATION ###
+
+# Opt-in profiling of the turtle & screen usage (enabled by DEBUG, see
+# enable_profiling()): every call is counted & timed, and attributed to the
+# flag being drawn and to the helper called by this flag drawing function
+# (horizontal_strips, cross_filled...). The profile is printed on exit.
+class Profiler(object):
+    def __init__(self):
+        self.calls = collections.Counter()  # (flag, helper, method) -> calls
+        self.times = collections.Counter()  # (flag, helper, method) -> s
+
+    def add(self, method, duration):
+        key = (*caller_flag_and_helper(sys._getframe(2)), method)
+        self.calls[key] += 1
+        self.times[key] += duration
+
+    def report(self):
+        return [{'flag': flag, 'helper': helper, 'method': method,
+                 'calls': self.calls[(flag, helper, method)],
+                 'seconds': round(self.times[(flag, helper, method)], 6)}
+                for flag, helper, method in self.times]
+
+    def dump(self, file=None):
+        file = file or sys.stderr
+        print("\nProfile (turtle & screen calls):", file=file)
+        print("{:24} {:24} {:16} {:>8} {:>10}".format(
+              "flag", "helper", "method", "calls", "ms"), file=file)
+        for e in sorted(self.report(), key=lambda e: -e['seconds']):
+            print("{flag:24} {helper:24} {method:16} {calls:8d} ".format(**e) +
+                  "{:10.3f}".format(e['seconds'] * 1000), file=file)
+
+# Find in the call stack the flag being drawn (a flag_* function, or a Flag
+# method replaying a flag) and the function this flag called (its helper)
+def caller_flag_and_helper(frame):
+    helper = None
+    while frame is not None:
+        if frame.f_globals is globals():
+            name = frame.f_code.co_name
+            flag = frame.f_locals.get('self')
+            if name.startswith("flag_"):
+                return name, helper or "-"
+            if isinstance(flag, Flag):
+                return flag.drawing_func.__name__, helper or name
+            helper = name
+        frame = frame.f_back
+    return "-", helper or "-"
+
+# Profiled turtle or screen: an OperationCounter which also reports every
+# call to the profiler
+class InstrumentedObject(OperationCounter):
+    def __init__(self, target, profiler):
+        OperationCounter.__init__(self, target)
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if not callable(attr):
+            return attr
+        counts = self.counts
+        profiler = self.profiler
+        def instrumented(*args, **kwargs):
+            counts[name] += 1
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                profiler.add(name, time.perf_counter() - start)
+        return instrumented
+
+profiler = None
+
+def enable_profiling():
+    global profiler
+    global ct
+    global screen
+    if profiler is not None:
+        return profiler
+    profiler = Profiler()
+    ct = InstrumentedObject(ct, profiler)
+    screen = InstrumentedObject(screen, profiler)
+    atexit.register(profiler.dump)
+    return profiler
+
+def debug(*args):
+    if DEBUG:
+        print(*args)
+
+
+### PNG RASTERIZER ###
+
+# Headless rendering of display lists to PNG files, with the standard
+# library only (no display, no inkscape...).
+
+# Tk color names used by the flags (add new ones here when needed)
+COLOR_NAMES = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'red': (255, 0, 0),
+    'green': (0, 128, 0),
+    'blue': (0, 0, 255),
+    'yellow': (255, 255, 0),
+    'orange': (255, 165, 0),
+    'gray': (190, 190, 190),
+    'grey': (190, 190, 190),
+}
+
+# Convert a Turtle color ('white', '#F93', '#0033A0', (r, g, b)...) to
+# a (r, g, b) tuple of integers in the 0..255 range
+def color_rgb(color):
+    if isinstance(color, tuple):
+        if all(isinstance(c, float) for c in color):  # colormode 1.0
+            return tuple(int(round(c * 255)) for c in color)
+        return tuple(int(c) for c in color)
+    if color.startswith('#'):
+        digits = color[1:]
+        n = len(digits) // 3
+        if n == 0 or len(digits) != n * 3:
+            raise ValueError("Bad color value: " + color)
+        rgb = [int(digits[i * n:(i + 1) * n], 16) for i in range(3)]
+        if n == 1:
+            return tuple(c * 17 for c in rgb)
+        return tuple(c >> (4 * (n - 2)) for c in rgb)
+    try:
+        return COLOR_NAMES[color.lower()]
+    except KeyError:
+        raise ValueError("Unknown color name: " + color) from None
+
+# Fill a polygon (list of (x, y) in pixel coordinates) into an RGB pixel
+# buffer. A pixel is filled when its center is inside the polygon
+# (even-odd rule), which is the usual scanline convention.
+def fill_polygon(pixels, width, height, points, rgb):
+    n = len(points)
+    if n < 3:
+        return
+    edges = []
+    for i in range(n):
+        x0, y0 = points[i - 1]
+        x1, y1 = points[i]
+        if y0 != y1:
+            edges.append((x0, y0, x1, y1))
+    if not edges:
+        return
+    y_min = min(min(e[1], e[3]) for e in edges)
+    y_max = max(max(e[1], e[3]) for e in edges)
+    row_first = max(0, int(math.ceil(y_min - 0.5)))
+    row_last = min(height - 1, int(math.ceil(y_max - 0.5)) - 1)
+    color = bytes(rgb)
+    for row in range(row_first, row_last + 1):
+        yc = row + 0.5
+        xs = []
+        for x0, y0, x1, y1 in edges:
+            if (y0 <= yc < y1) or (y1 <= yc < y0):
+                xs.append(x0 + (yc - y0) * (x1 - x0) / (y1 - y0))
+        xs.sort()
+        offset = row * width
+        for i in range(0, len(xs) - 1, 2):
+            first = max(0, int(math.ceil(xs[i] - 0.5)))
+            last = min(width, int(math.ceil(xs[i + 1] - 0.5)))
+            if first < last:
+                pixels[(offset + first) * 3:(offset + last) * 3] = \
+                    color * (last - first)
+
+# Rasterize the display list area starting at (x, y) (top left corner in
+# Turtle coordinates) of size width x height into a pixel_width x
+# pixel_height RGB buffer (bytearray).
+def rasterize(items, x, y, width, height, pixel_width, pixel_height,
+              background='white'):
+    pixels = bytearray(bytes(color_rgb(background)) *
+                       (pixel_width * pixel_height))
+    sx = pixel_width / width
+    sy = pixel_height / height
+    for item in items:
+        points = [((px - x) * sx, (y - py) * sy) for px, py in item.points]
+        fill_polygon(pixels, pixel_width, pixel_height, points,
+                     color_rgb(item.color))
+    return pixels
+
+def png_chunk(chunk_type, data):
+    chunk = chunk_type + data
+    return (struct.pack(">I", len(data)) + chunk +
+            struct.pack(">I", zlib.crc32(chunk) & 0xffffffff))
+
+# Encode an RGB pixel buffer to the PNG file format (bytes)
+def encode_png(width, height, pixels, compression=6):
+    stride = width * 3
+    raw = bytearray()
+    for row in range(height):
+        raw.append(0)  # Filter type "None"
+        raw += pixels[row * stride:(row + 1) * stride]
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' +
+            png_chunk(b'IHDR', header) +
+            png_chunk(b'IDAT', zlib.compress(bytes(raw), compression)) +
+            png_chunk(b'IEND', b''))
+
+def write_png(filename, width, height, pixels):
+    with open(filename, 'wb') as fh:
+        fh.write(encode_png(width, height, pixels))
+
+# Decode the png files written by encode_png() (8 bits RGB without filter),
+# return width, height & pixels
+def decode_png(data):
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("Not a png file")
+    position = 8
+    header = None
+    compressed = bytearray()
+    while position < len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, position)
+        chunk = data[position + 8:position + 8 + length]
+        position += length + 12  # length, type, data & crc
+        if chunk_type == b'IHDR':
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b'IDAT':
+            compressed += chunk
+    if header is None or header[2:] != (8, 2, 0, 0, 0):
+        raise ValueError("Unsupported png format")
+    width, height = header[:2]
+    raw = zlib.decompress(bytes(compressed))
+    stride = width * 3
+    pixels = bytearray()
+    for row in range(height):
+        start = row * (stride + 1)
+        if raw[start] != 0:
+            raise ValueError("Unsupported png filter")
+        pixels += raw[start + 1:start + 1 + stride]
+    return width, height, pixels
+
+
+### GIF ENCODER ###
+
+# Animated GIF files with the standard library only: one global palette
+# (flags only use a few colors), each frame is cropped to the area which
+# changed since the previous frame and compressed with LZW.
+
+GIF_MAX_CODE_SIZE = 12
+
+# Global palette of RGB pixel buffers: dict {rgb bytes: index}
+def gif_palette(frames):
+    palette = dict()
+    for pixels in frames:
+        for i in range(0, len(pixels), 3):
+            rgb = bytes(pixels[i:i + 3])
+            if rgb not in palette:
+                if len(palette) == 256:
+                    raise ValueError("Too many colors for a gif file")
+                palette[rgb] = len(palette)
+    return palette
+
+# Bounding box (left, top, right, bottom) of the pixels which differ
+# between two RGB buffers, None if the buffers are the same
+def frame_difference(previous, pixels, width, height):
+    stride = width * 3
+    rows = [row for row in range(height)
+            if previous[row * stride:(row + 1) * stride] !=
+               pixels[row * stride:(row + 1) * stride]]
+    if not rows:
+        return None
+    left, right = width, 0
+    for row in rows:
+        offset = row * stride
+        x = 0
+        while previous[offset + x * 3:offset + x * 3 + 3] == \
+              pixels[offset + x * 3:offset + x * 3 + 3]:
+            x += 1
+        left = min(left, x)
+        x = width
+        while previous[offset + x * 3 - 3:offset + x * 3] == \
+              pixels[offset + x * 3 - 3:offset + x * 3]:
+            x -= 1
+        right = max(right, x)
+    return left, rows[0], right, rows[-1] + 1
+
+# LZW compression of palette indexes (variable length codes, LSB first)
+def lzw_encode(indexes, min_code_size):
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    out = bytearray()
+    bits = 0
+    nbits = 0
+    def emit(code, next_code):
+        nonlocal bits, nbits
+        bits |= code << nbits
+        nbits += max(min_code_size + 1, (next_code - 1).bit_length())
+        while nbits >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            nbits -= 8
+    table = dict()
+    next_code = end_code + 1
+    emit(clear_code, next_code)
+    prefix = None
+    for index in indexes:
+        if prefix is None:
+            prefix = index
+            continue
+        key = (prefix, index)
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, next_code)
+        if next_code < 1 << GIF_MAX_CODE_SIZE:
+            table[key] = next_code
+            next_code += 1
+        else:
+            emit(clear_code, next_code)
+            table.clear()
+            next_code = end_code + 1
+        prefix = index
+    if prefix is not None:
+        emit(prefix, next_code)
+    emit(end_code, next_code)
+    if nbits:
+        out.append(bits & 0xff)
+    return bytes(out)
+
+# Encode RGB frames (all of the same size) to an animated GIF file (bytes).
+# delays are the frame durations in hundredths of second. Frames without
+# any change are merged into the previous one.
+def encode_gif(width, height, frames, delays, loop=0):
+    palette = gif_palette(frames)
+    size = max(1, (len(palette) - 1).bit_length())
+    colors = b''.join(palette) + b'\0' * (3 * ((1 << size) - len(palette)))
+    data = bytearray(b'GIF89a')
+    data += struct.pack("<HHBBB", width, height, 0xf0 | (size - 1), 0, 0)
+    data += colors
+    data += b'\x21\xff\x0bNETSCAPE2.0' + struct.pack("<BBHB", 3, 1, loop, 0)
+    images = []
+    previous = None
+    for pixels, delay in zip(frames, delays):
+        if previous is None:
+            box = (0, 0, width, height)
+        else:
+            box = frame_difference(previous, pixels, width, height)
+        previous = pixels
+        if box is None:
+            images[-1][1] += delay
+        else:
+            images.append([box, delay, pixels])
+    min_code_size = max(2, size)
+    for (left, top, right, bottom), delay, pixels in images:
+        indexes = []
+        for row in range(top, bottom):
+            offset = (row * width + left) * 3
+            indexes.extend(palette[bytes(pixels[i:i + 3])]
+                           for i in range(offset, offset + (right - left) * 3,
+                                          3))
+        # Graphic control extension: "do not dispose" & frame duration
+        data += struct.pack("<BBBBHBB", 0x21, 0xf9, 4, 1 << 2, delay, 0, 0)
+        data += struct.pack("<BHHHHB", 0x2c, left, top, right - left,
+                            bottom - top, 0)
+        data.append(min_code_size)
+        compressed = lzw_encode(indexes, min_code_size)
+        for i in range(0, len(compressed), 255):
+            block = compressed[i:i + 255]
+            data.append(len(block))
+            data += block
+        data.append(0)
+    data.append(0x3b)
+    return bytes(data)
+
+
 ### COUNTRY FLAG DRAWING FUNCTIONS ###
 
 # Note Following functions do not take into account directly the
@@ -390,11 +1299,9 @@ def flag_India(x, y, width, height):
     radius_external = width * 105/1350
     angle_spoke = 4.9 / 360 # 4.9 degrees
     for i in [x/24 for x in range(24)]:  # 0/24, 1/24, 2/24...
-        ### The polygon spoke
+        ### The polygon spoke (oriented along its axis for stamping)
         ct.color('#008')
-        ct.penup()
-        ct.goto(circle_coord(cx, cy, radius_internal, i))
-        ct.pendown()
+        prepare_drawing(*circle_coord(cx, cy, radius_internal, i), i * 360)
         ct.begin_fill()
         ct.goto(circle_coord(cx, cy, radius_middle, i - angle_spoke))
         ct.goto(circle_coord(cx, cy, radius_external, i))
@@ -529,17 +1436,534 @@ def flag_United_States(x, y, width, height):
 
 ### FLAGS MANAGEMENT FUNCTIONS ###
 
+# A flag compiled in unit space: its drawing is done once (at the
+# reference width), then all the vertices are normalized in the unit
+# square and stored in a flat coordinate array. Drawing the flag at any
+# position & size is then only an affine transform of this array.
+# Note: y coordinates are in [-1, 0] (Turtle y-axis goes up).
+class CompiledFlag(object):
+    def __init__(self, items, width, height):
+        self.colors = []
+        self.offsets = array('l', [0])  # shape i points: offsets[i:i + 2]
+        self.coords = array('d')        # x0, y0, x1, y1...
+        self.anchors = array('d')       # x, y, heading for each shape
+        for item in items:
+            self.colors.append(item.color)
+            ax, ay, heading = item.anchor
+            self.anchors.extend((ax / width, ay / height, heading))
+            for x, y in item.points:
+                self.coords.append(x / width)
+                self.coords.append(y / height)
+            self.offsets.append(len(self.coords) // 2)
+        self._numpy_coords = None
+
+    # Compiled flag using the given arrays (or memoryviews) as they are
+    @classmethod
+    def from_arrays(cls, colors, offsets, coords, anchors):
+        compiled = cls.__new__(cls)
+        compiled.colors = colors
+        compiled.offsets = offsets
+        compiled.coords = coords
+        compiled.anchors = anchors
+        compiled._numpy_coords = None
+        return compiled
+
+    def __len__(self):
+        return len(self.colors)
+
+    def vertex_count(self):
+        return len(self.coords) // 2
+
+    # Return the transformed x & y coordinates lists
+    def transform(self, x, y, width, height):
+        numpy = import_numpy() if USE_NUMPY else None
+        if numpy:
+            if self._numpy_coords is None:
+                self._numpy_coords = numpy.frombuffer(
+                    self.coords, dtype=numpy.float64).reshape(-1, 2)
+            points = self._numpy_coords * (width, height) + (x, y)
+            return points[:, 0].tolist(), points[:, 1].tolist()
+        coords = self.coords
+        return ([x + u * width for u in coords[0::2]],
+                [y + v * height for v in coords[1::2]])
+
+    def display_list(self, x, y, width, height):
+        xs, ys = self.transform(x, y, width, height)
+        offsets = self.offsets
+        anchors = self.anchors
+        return [FilledPolygon(color, tuple(zip(xs[offsets[i]:offsets[i + 1]],
+                                               ys[offsets[i]:offsets[i + 1]])),
+                              (x + anchors[i * 3] * width,
+                               y + anchors[i * 3 + 1] * height,
+                               anchors[i * 3 + 2]))
+                for i, color in enumerate(self.colors)]
+
+# numpy is optional, it is imported on first use (it is slow to import)
+numpy_module = None
+
+def import_numpy():
+    global numpy_module
+    if numpy_module is None:
+        try:
+            import numpy
+            numpy_module = numpy
+        except ImportError:
+            numpy_module = False
+    return numpy_module
+
+# Compile a flag drawing function in unit space for the given aspect
+# ratio (height / width). Circles are only circles for the compiled aspect
+# ratio, this is why the aspect ratio is part of the compilation.
+# The flag is drawn at "width", so circles get the right number of segments
+# for this width (see circle_steps()).
+def compile_flag(drawing_func, aspect, width, level=None):
+    height = width * aspect
+    items = record(drawing_func, 0, 0, width, height)
+    if level == LOD_REDUCED:
+        # The compiled flag is used down to width / 2 (see compile_width())
+        items = reduce_details(items, LOD_MIN_DETAIL * 2)
+    elif level == LOD_SWATCH:
+        items = swatch(items, width, height)
+    if OPTIMIZE_SHAPES:
+        items = optimize_shapes(items)
+    return CompiledFlag(items, width, height)
+
+def compile_width(width):
+    return max(COMPILE_MIN_WIDTH, 2 ** math.ceil(math.log2(abs(width))))
+
+
+### LEVELS OF DETAIL ###
+
+# Flags are drawn with a level of detail depending on their width:
+# - full: all the shapes,
+# - reduced: without the shapes smaller than LOD_MIN_DETAIL pixels (stars
+#   of small United States flags, India chakra rim circles...),
+# - swatch: the flag pixels (at the compiled width) merged into same color
+#   rectangles, for very small flags: strips flags give a few rectangles
+#   and the most complex flags are bounded by their number of pixel rows.
+# A level is only used if its drawing is close enough to the full drawing
+# (see Flag.lod()), else the next more detailed level is used.
+LOD_FULL = "full"
+LOD_REDUCED = "reduced"
+LOD_SWATCH = "swatch"
+LOD_LEVELS = (LOD_FULL, LOD_REDUCED, LOD_SWATCH)  # Most detailed first
+
+def lod_level(width):
+    if width < LOD_SWATCH_WIDTH:
+        return LOD_SWATCH
+    if width < LOD_REDUCED_WIDTH:
+        return LOD_REDUCED
+    return LOD_FULL
+
+def reduce_details(items, min_size):
+    reduced = []
+    for item in items:
+        xs = [x for x, _ in item.points]
+        ys = [y for _, y in item.points]
+        if max(max(xs) - min(xs), max(ys) - min(ys)) >= min_size:
+            reduced.append(item)
+    return reduced
+
+# Pixels of a display list drawn at (0, 0) as rectangles: same color
+# pixels are merged in horizontal runs, then same runs of consecutive rows
+# are merged into rectangles.
+def swatch(items, width, height):
+    columns = max(1, int(round(width)))
+    rows = max(1, int(round(height)))
+    pixels = rasterize(items, 0, 0, width, height, columns, rows)
+    block_w = width / columns
+    block_h = height / rows
+    rectangles = []
+    opened = {}  # (first column, last column, color) -> first row
+    for row in range(rows + 1):
+        runs = set()
+        if row < rows:
+            offset = row * columns * 3
+            first = 0
+            for col in range(1, columns + 1):
+                if col == columns or \
+                   pixels[offset + col * 3:offset + col * 3 + 3] != \
+                   pixels[offset + first * 3:offset + first * 3 + 3]:
+                    color = "#" + pixels[offset + first * 3:
+                                         offset + first * 3 + 3].hex()
+                    runs.add((first, col, color))
+                    first = col
+        # Close the rectangles not continued on this row
+        for run in [r for r in opened if r not in runs]:
+            first_col, end_col, color = run
+            x0, x1 = first_col * block_w, end_col * block_w
+            y0, y1 = -opened.pop(run) * block_h, -row * block_h
+            rectangles.append(FilledPolygon(color, ((x0, y0), (x1, y0),
+                                                    (x1, y1), (x0, y1))))
+        for run in sorted(runs):  # Same rectangles order in all processes
+            opened.setdefault(run, row)
+    return rectangles
+
+# Mean color difference (0.0 = identical, 1.0 = black vs white) between two
+# display lists drawn at (0, 0) with the given size
+def display_list_error(items, reference, width, height):
+    w, h = max(1, int(round(width))), max(1, int(round(height)))
+    pixels = rasterize(items, 0, 0, width, height, w, h)
+    reference_pixels = rasterize(reference, 0, 0, width, height, w, h)
+    diff = 0
+    stride = w * 3
+    for offset in range(0, len(pixels), stride):  # Only the different rows
+        row = pixels[offset:offset + stride]
+        reference_row = reference_pixels[offset:offset + stride]
+        if row != reference_row:
+            diff += sum(abs(a - b) for a, b in zip(row, reference_row))
+    return diff / (255 * len(pixels))
+
+
+### SHAPES OPTIMIZATION ###
+
+# Many flags paint a background then cover it (partially or totally), or
+# draw a shape in several pieces (cross_filled() draws 2 rectangles). The
+# optimization pass removes the shapes totally covered by the shapes drawn
+# after them, and merges the overlapping or touching same color rectangles
+# into a single polygon, giving less canvas items & less filling work.
+# The optimized drawing must be pixel identical, see check_optimization().
+
+# Return (x0, y0, x1, y1) with x0 < x1 & y0 < y1 if the shape is an axis
+# aligned rectangle, else None
+def shape_rectangle(item, eps=1e-9):
+    points = list(item.points)
+    if len(points) > 4 and abs(points[0][0] - points[-1][0]) <= eps and \
+       abs(points[0][1] - points[-1][1]) <= eps:
+        points.pop()
+    if len(points) != 4:
+        return None
+    xs = sorted(x for x, _ in points)
+    ys = sorted(y for _, y in points)
+    if xs[1] - xs[0] > eps or xs[3] - xs[2] > eps or xs[2] - xs[1] <= eps or \
+       ys[1] - ys[0] > eps or ys[3] - ys[2] > eps or ys[2] - ys[1] <= eps:
+        return None
+    # Each corner must be used once (no "bow tie" shape)
+    corners = set((x - xs[0] > eps, y - ys[0] > eps) for x, y in points)
+    if len(corners) != 4:
+        return None
+    return xs[0], ys[0], xs[3], ys[3]
+
+def bounding_box(item):
+    xs = [x for x, _ in item.points]
+    ys = [y for _, y in item.points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def boxes_touch(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+# Convex polygon points in counter-clockwise order (None if not convex)
+def convex_polygon(item):
+    points = []
+    for p in item.points:
+        if not points or p != points[-1]:
+            points.append(p)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    n = len(points)
+    if n < 3:
+        return None
+    sign = 0
+    for i in range(n):
+        (x0, y0), (x1, y1), (x2, y2) = points[i - 2], points[i - 1], points[i]
+        cross = (x1 - x0) * (y2 - y1) - (y1 - y0) * (x2 - x1)
+        if cross != 0:
+            if sign == 0:
+                sign = 1 if cross > 0 else -1
+            elif (cross > 0) != (sign > 0):
+                return None
+    return points if sign >= 0 else points[::-1]
+
+def inside_convex(points, convex):
+    n = len(convex)
+    for x, y in points:
+        for i in range(n):
+            (x0, y0), (x1, y1) = convex[i - 1], convex[i]
+            if (x1 - x0) * (y - y0) - (y1 - y0) * (x - x0) < 0:
+                return False
+    return True
+
+# True if the rectangle is covered by the union of the rectangles
+def rectangle_covered(rect, rectangles):
+    x0, y0, x1, y1 = rect
+    rectangles = [r for r in rectangles
+                  if r[0] < x1 and x0 < r[2] and r[1] < y1 and y0 < r[3]]
+    xs = sorted(set([x0, x1] + [min(max(r[i], x0), x1)
+                                for r in rectangles for i in (0, 2)]))
+    ys = sorted(set([y0, y1] + [min(max(r[i], y0), y1)
+                                for r in rectangles for i in (1, 3)]))
+    for i in range(len(xs) - 1):
+        cx = (xs[i] + xs[i + 1]) / 2
+        for j in range(len(ys) - 1):
+            cy = (ys[j] + ys[j + 1]) / 2
+            if not any(r[0] <= cx <= r[2] and r[1] <= cy <= r[3]
+                       for r in rectangles):
+                return False
+    return True
+
+# Outline of a union of axis aligned rectangles, None if this union is not
+# a simple polygon (several parts, holes, corners touching...)
+def rectangles_union(rectangles):
+    xs = sorted(set(r[i] for r in rectangles for i in (0, 2)))
+    ys = sorted(set(r[i] for r in rectangles for i in (1, 3)))
+    cells = set()
+    for i in range(len(xs) - 1):
+        cx = (xs[i] + xs[i + 1]) / 2
+        for j in range(len(ys) - 1):
+            cy = (ys[j] + ys[j + 1]) / 2
+            if any(r[0] <= cx <= r[2] and r[1] <= cy <= r[3]
+                   for r in rectangles):
+                cells.add((i, j))
+    # Counter-clockwise cell borders, the inner ones cancel each other
+    borders = set()
+    for i, j in cells:
+        corners = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+        for k in range(4):
+            start, end = corners[k], corners[(k + 1) % 4]
+            if (end, start) in borders:
+                borders.remove((end, start))
+            else:
+                borders.add((start, end))
+    edges = dict(borders)
+    if not edges or len(edges) != len(borders):
+        return None  # Two borders starting from the same corner
+    start = min(edges)
+    outline = [start]
+    point = edges.pop(start)
+    while point != start:
+        outline.append(point)
+        point = edges.pop(point, None)
+        if point is None:
+            return None
+    if edges:
+        return None  # Several parts or holes
+    # Remove the points in the middle of straight lines
+    vertices = []
+    n = len(outline)
+    for k in range(n):
+        (i0, j0), (i1, j1), (i2, j2) = outline[k - 1], outline[k], \
+                                       outline[(k + 1) % n]
+        if not ((i0 == i1 == i2) or (j0 == j1 == j2)):
+            vertices.append((xs[i1], ys[j1]))
+    return tuple(vertices + vertices[:1])
+
+def optimize_shapes(items):
+    items = list(items)
+    # 1) Remove the shapes covered by a convex shape drawn after them or by
+    # the union of the rectangles drawn after them
+    kept = []
+    for i, item in enumerate(items):
+        later = items[i + 1:]
+        rect = shape_rectangle(item)
+        covered = False
+        for other in later:
+            convex = convex_polygon(other)
+            if convex is not None and inside_convex(item.points, convex):
+                covered = True
+                break
+        if not covered and rect is not None:
+            rectangles = [r for r in map(shape_rectangle, later) if r]
+            covered = bool(rectangles) and rectangle_covered(rect, rectangles)
+        if not covered:
+            kept.append(item)
+    # 2) Merge a rectangle with a previous same color rectangle (or merged
+    # rectangles) touching it, if no shape drawn between them touches this
+    # previous one (as the merged shape is drawn later)
+    merged = []  # shapes
+    parts = []   # rectangles of each shape (None if not made of rectangles)
+    for item in kept:
+        rect = shape_rectangle(item)
+        item_parts = [rect] if rect is not None else None
+        if rect is not None:
+            for k in range(len(merged) - 1, -1, -1):
+                box = bounding_box(merged[k])
+                if merged[k].color != item.color or parts[k] is None or \
+                   not boxes_touch(box, rect):
+                    continue
+                if any(boxes_touch(box, bounding_box(other))
+                       for other in merged[k + 1:]):
+                    continue
+                outline = rectangles_union(parts[k] + [rect])
+                if outline is not None:
+                    item = FilledPolygon(item.color, outline,
+                                         outline[0] + (0,))
+                    item_parts = parts[k] + [rect]
+                    del merged[k]
+                    del parts[k]
+                    break
+        merged.append(item)
+        parts.append(item_parts)
+    return merged
+
+# Check that the optimization pass gives the same pixels as the original
+# drawing for every flag at the given widths, return the number of
+# different pixels by (flag name, width)
+def check_optimization(widths=(32, 160, 416)):
+    differences = {}
+    for func, flag in flags_dict.items():
+        for width in widths:
+            height = int(round(width * flag.ratio))
+            items = record(func, 0, 0, width, height)
+            pixels = rasterize(items, 0, 0, width, height, width, height)
+            optimized = rasterize(optimize_shapes(items), 0, 0, width, height,
+                                  width, height)
+            differences[(func.__name__, width)] = sum(
+                pixels[i:i + 3] != optimized[i:i + 3]
+                for i in range(0, len(pixels), 3))
+    return differences
+
+# Bounded LRU cache of computed flag geometries (compiled flags), with
+# hits/misses statistics. Keys are tuples starting with the flag.
+class GeometryCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # The cache can be used from several threads (see RenderContext).
+        # The values are computed without holding the lock: two threads may
+        # compute the same value, the last one is kept.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Return the cached value of "key", compute it with compute() if missing
+    def get(self, key, compute):
+        with self._lock:
+            value = self._entries.get(key, self)
+            if value is not self:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)  # Least recently used
+        return value
+
+    # Remove the entries of the given flag (all entries if flag is None)
+    def invalidate(self, flag=None):
+        with self._lock:
+            if flag is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[0] is flag]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
 class Flag(object):
+    # Shared by all the flags (sized once all the flags are defined)
+    geometry_cache = GeometryCache(GEOMETRY_CACHE_SIZE)
+
     def __init__(self, country_code, ratio, drawing_func):
         self.country_code = country_code
         self.ratio = ratio
         self.drawing_func = drawing_func
-
-    def draw(self, x, y, width, height):
-        self.drawing_func(x, y, width, height)
-
-    def draw_ratio(self, x, y, width):
-        self.drawing_func(x, y, width, width * self.ratio)
+        # Chosen levels of detail: {(aspect, compile width, level): level}
+        self.lod_levels = dict()
+
+    # In fast mode (or when recording), the flag is replayed from its
+    # cached geometry, else the drawing function is called so that the
+    # turtle animation can be seen.
+    # The flag is drawn with the current turtle, or with target if given (a
+    # turtle, a Recorder, a RasterTarget... or a RenderContext).
+    def draw(self, x, y, width, height, target=None):
+        if target is not None:
+            if not isinstance(target, RenderContext):
+                target = RenderContext(target)
+            with render_context(target):
+                self.draw(x, y, width, height)
+            return
+        if context_fast_draw() or current_recorder() is not None:
+            draw_display_list(self.record(x, y, width, height))
+        else:
+            self.drawing_func(x, y, width, height)
+
+    def draw_ratio(self, x, y, width, target=None):
+        self.draw(x, y, width, width * self.ratio, target)
+
+    # Flag compiled in unit space for the given aspect ratio & width.
+    # Flags are compiled once per aspect ratio and power of 2 width: the
+    # circles segments computed for the upper power of 2 are always precise
+    # enough for smaller widths, and there is no need of more segments.
+    # The compiled flags cache file is used before the drawing function.
+    def compiled(self, aspect, width, level=LOD_FULL):
+        aspect = round(aspect, 6)
+        width = compile_width(width)
+        def compute():
+            compiled = compiled_cache.compiled(self, aspect, width, level)
+            if compiled is None:
+                compiled = compile_flag(self.drawing_func, aspect, width,
+                                        level)
+            return compiled
+        return Flag.geometry_cache.get((self, aspect, width, level), compute)
+
+    # Level of detail to use for the given size: the level depending on the
+    # width if it is close enough to the full drawing and not more complex
+    # than the more detailed level (swatches of diagonal flags...), else the
+    # more detailed level (the checks are done once per compiled geometry,
+    # the chosen level is kept so the checked geometries can leave the
+    # cache)
+    def lod(self, width, height):
+        level = lod_level(width)
+        key = (round(height / width, 6), compile_width(width), level)
+        chosen = self.lod_levels.get(key)
+        if chosen is None:
+            chosen = self.choose_lod(level, width, height)
+            self.lod_levels[key] = chosen
+        return chosen
+
+    def choose_lod(self, level, width, height):
+        while level != LOD_FULL:
+            detailed = LOD_LEVELS[LOD_LEVELS.index(level) - 1]
+            if self.lod_error(level, width, height) <= LOD_MAX_ERROR and \
+               self.compiled(height / width, width, level).vertex_count() <= \
+               self.compiled(height / width, width, detailed).vertex_count():
+                break
+            level = detailed
+        return level
+
+    def lod_error(self, level, width, height):
+        aspect = round(height / width, 6)
+        width = compile_width(width)
+        def compute():
+            error = compiled_cache.lod_error(self, aspect, width, level)
+            if error is not None:
+                return error
+            height = width * aspect
+            full = self.compiled(aspect, width).display_list(0, 0, width,
+                                                              height)
+            items = self.compiled(aspect, width, level).display_list(
+                0, 0, width, height)
+            return display_list_error(items, full, width, height)
+        return Flag.geometry_cache.get((self, aspect, width, level, "error"),
+                                       compute)
+
+    # Forget the cached geometries of this flag (to call after a change
+    # of its drawing function)
+    def invalidate_geometry(self):
+        Flag.geometry_cache.invalidate(self)
+        self.lod_levels.clear()
+        compiled_cache.invalidate(self)
+
+    # Same as draw() & draw_ratio() but return the flag display list
+    # instead of drawing it
+    # The level of detail is chosen from the size if not given
+    def record(self, x, y, width, height, level=None):
+        if level is None:
+            level = self.lod(width, height)
+        return self.compiled(height / width, width, level).display_list(
+            x, y, width, height)
+
+    def record_ratio(self, x, y, width):
+        return self.record(x, y, width, width * self.ratio)
 
 # Dictionnary of all the flags (the key is the flag drawing function)
 flags_dict = dict()
@@ -576,6 +2000,8 @@ flags_dict[flag_Sweden]        = Flag(752,  5/8 , flag_Sweden)
 flags_dict[flag_United_Kingdom]= Flag(826,  1/2 , flag_United_Kingdom)
 flags_dict[flag_United_States] = Flag(840, 10/19, flag_United_States)
 
+Flag.geometry_cache.maxsize = GEOMETRY_CACHE_SIZE * len(flags_dict)
+
 
 # Function to remove accents, useful for sorting, else "États-Unis" (fr)
 # will be the last of the sorting list in French
@@ -584,93 +2010,661 @@ def strip_accents(s):
     return ''.join(c for c in unicodedata.normalize('NFD', s)
                    if unicodedata.category(c) != 'Mn')
 
-# Sort the flags dictionnary by country code
-sorted(flags_dict.items(), key=lambda x: x[1].country_code)
 
 
-def draw_all_flags(width, border, country_names=False, ratio=False):
-    global flags_dict
-    # Get window size
-    window_width = screen.window_width()
-    window_height = screen.window_height()
-    #setup(window_width * 1.0, window_height * 1.0)
-    #print(screensize(), screen.window_width(), screen.window_height())
-    flags_num = len(flags_dict)
-    x_start = -(window_width / 2) + border # TODO rename border please
-    y_start = (window_height / 2) - border
-    flags_horiz_max = int((window_width - 2 * border) / width)
-    print(flags_horiz_max)
-    # TODO rename border_inside
-    border_inside = (window_width - (2 * border)) - (flags_horiz_max * width)
-    border_inside /= (flags_horiz_max - 1)
-    if border_inside < border:
-        flags_horiz_max -= 1
-        border_inside = (window_width - (2 * border)) - (flags_horiz_max * width)
-        border_inside /= (flags_horiz_max - 1)
-    x = x_start
-    y = y_start
-    print(x, y, border_inside)
-    for i in flags_dict:
-        # Get the flag and draw it
-        flag = flags_dict[i]
-        if ratio:
-            h = width * flag.ratio
-            flag.draw_ratio(x, y, width)
+### FLAGS INDEX ###
+
+# Catalogue of the flags: lookups by ISO 3166 numeric code, alpha-2 or
+# alpha-3 code and localized country name, and sorted lists of flags.
+# Everything is computed once: the alpha codes when first needed (they are
+# read from the COUNTRY_CODES_FILENAME file) and the names of a language
+# when the language is loaded (see load_country_names()).
+# Note: flags_dict is kept in the drawing order, use the sorted lists here.
+class FlagIndex(object):
+    def __init__(self, flags, codes_filename):
+        self.flags = list(flags)
+        self.codes_filename = codes_filename
+        self.by_code = {flag.country_code: flag for flag in self.flags}
+        self.by_alpha = None  # {alpha-2 or alpha-3 code: flag}
+        self.alpha_codes = None  # {numeric code: (alpha-2, alpha-3)}
+        self.by_name = dict()  # {language: {collation key: flag}}
+        self.orderings = dict()  # {ordering: list of flags}
+
+    def load_alpha_codes(self):
+        self.alpha_codes = dict()
+        self.by_alpha = dict()
+        with open(self.codes_filename, encoding='utf-8') as fh:
+            for line in fh:
+                if line.startswith("#"): # Ignore commented lines
+                    continue
+                code, alpha2, alpha3 = line.rstrip().split(";")
+                self.alpha_codes[int(code)] = (alpha2, alpha3)
+                flag = self.by_code.get(int(code))
+                if flag is not None:
+                    self.by_alpha[alpha2] = flag
+                    self.by_alpha[alpha3] = flag
+
+    # (alpha-2, alpha-3) codes of a flag, ("", "") if unknown
+    def codes(self, flag):
+        if self.alpha_codes is None:
+            self.load_alpha_codes()
+        return self.alpha_codes.get(flag.country_code, ("", ""))
+
+    def code(self, code):
+        return self.by_code.get(code)
+
+    def alpha(self, code):
+        if self.by_alpha is None:
+            self.load_alpha_codes()
+        return self.by_alpha.get(code.upper())
+
+    # Flag of a country name in a loaded language (accents & case ignored)
+    def name(self, name, language=None):
+        if language is None:
+            if current_country_names is None:
+                return None
+            language = current_country_names.language
+        return self.by_name.get(language, {}).get(collation_key(name))
+
+    # Flag from any key: numeric code (250 or "250"), alpha code ("FR",
+    # "fra") or country name in the current language, None if not found
+    def lookup(self, key):
+        if isinstance(key, int):
+            return self.code(key)
+        key = key.strip()
+        if key.isdigit():
+            return self.code(int(key))
+        flag = None
+        if len(key) in (2, 3):
+            flag = self.alpha(key)
+        return flag or self.name(key)
+
+    # Index the names of a loaded language (the other languages are kept)
+    def add_language(self, names):
+        self.by_name[names.language] = {
+            names.collation_key(flag.country_code): flag
+            for flag in self.flags if flag.country_code in names.names}
+        self.orderings['name', names.language] = sorted(
+            self.flags, key=lambda flag: (names.collation_key(
+                flag.country_code), flag.country_code))
+
+    # Flags sorted with key, computed once per ordering name
+    def ordering(self, ordering, key):
+        flags = self.orderings.get(ordering)
+        if flags is None:
+            flags = sorted(self.flags, key=key)
+            self.orderings[ordering] = flags
+        return flags
+
+    def sorted_by_code(self):
+        return self.ordering('code', lambda flag: flag.country_code)
+
+    def sorted_by_ratio(self):
+        return self.ordering('ratio', lambda flag: (flag.ratio,
+                                                  flag.country_code))
+
+    # Flags sorted by country name in a loaded language (the current one by
+    # default), sorted by country code if the language is not loaded
+    def sorted_by_name(self, language=None):
+        if language is None and current_country_names is not None:
+            language = current_country_names.language
+        return self.orderings.get(('name', language)) or self.sorted_by_code()
+
+    # Flags whose name contains text in the current language (by name)
+    def search(self, text):
+        if current_country_names is None:
+            return []
+        return [self.by_code[code]
+                for code in current_country_names.search(text)
+                if code in self.by_code]
+
+flag_index = FlagIndex(flags_dict.values(), os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), COUNTRY_CODES_FILENAME))
+
+
+### COMPILED FLAGS CACHE FILE ###
+
+# The compiled flags (see CompiledFlag) of the exported sizes, with their
+# levels of detail errors, are saved in a binary file. The next processes
+# (export workers, threads, gallery...) map this file in memory and draw
+# their flags from its arrays without running the flag drawing functions.
+# The file is tied to a hash of this source file & of the geometry settings:
+# it is ignored when they change. ensure_compiled_cache() (called by
+# batch_export() with the exported sizes, see also --build-cache) rebuilds
+# it, or adds the missing sizes.
+#
+# File layout (the arrays are aligned on 8 bytes and use the native byte
+# order, which is part of the fingerprint):
+#   header:   magic, version, fingerprint, entries count, metadata size
+#   metadata: json with the colors table & the flag function names
+#   entries:  flag index, level index, aspect, compile width, lod error
+#             (NaN for the full level), shapes count, vertices count and
+#             position of the entry arrays in the file
+#   arrays:   for each entry, the shape color indexes (uint32), the shape
+#             offsets (int64), the coordinates & the anchors (double)
+COMPILED_CACHE_MAGIC = b"FLAGGEOM"
+COMPILED_CACHE_VERSION = 1
+COMPILED_CACHE_HEADER = struct.Struct("<8sI40sII")
+COMPILED_CACHE_ENTRY = struct.Struct("<HHdIdIIQ")
+
+def align8(size):
+    return (size + 7) // 8 * 8
+
+# Settings changing the compiled flags (other than the drawing functions)
+def geometry_settings():
+    return (OPTIMIZE_SHAPES, CIRCLE_TOLERANCE, CIRCLE_MIN_STEPS,
+            CIRCLE_MAX_STEPS, LOD_MIN_DETAIL, COMPILE_MIN_WIDTH,
+            sys.byteorder)
+
+def geometry_fingerprint(settings=None):
+    settings = geometry_settings() if settings is None else settings
+    return hashlib.sha1((source_hash() + repr(settings)).encode()).hexdigest()
+
+class CompiledCacheFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        # (flag, aspect, width, level): (lod error, shapes, vertices,
+        # position), None until the file is opened
+        self.entries = None
+        self.settings = None
+        self.colors = None
+        self.data = None
+        self._lock = threading.Lock()
+
+    # Map the file in memory if it is valid (else no entries)
+    def open(self):
+        with self._lock:
+            if self.entries is not None:
+                return
+            self.settings = geometry_settings()
+            self.entries = self.read(geometry_fingerprint(self.settings))
+
+    def read(self, fingerprint):
+        try:
+            with open(self.filename, 'rb') as fh:
+                data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Missing or empty file
+            return {}
+        if len(data) < COMPILED_CACHE_HEADER.size:
+            return {}
+        magic, version, file_fingerprint, count, metadata_size = \
+            COMPILED_CACHE_HEADER.unpack_from(data)
+        if magic != COMPILED_CACHE_MAGIC or \
+           version != COMPILED_CACHE_VERSION or \
+           file_fingerprint.decode('ascii') != fingerprint:
+            data.close()
+            return {}
+        position = COMPILED_CACHE_HEADER.size
+        metadata = json.loads(data[position:position + metadata_size]
+                              .decode('utf-8'))
+        position += metadata_size
+        flags = flags_by_func_name()
+        file_flags = [flags.get(name) for name in metadata['flags']]
+        self.colors = metadata['colors']
+        entries = {}
+        for _ in range(count):
+            flag_number, level_index, aspect, width, error, shapes, \
+                vertices, start = COMPILED_CACHE_ENTRY.unpack_from(data,
+                                                                   position)
+            position += COMPILED_CACHE_ENTRY.size
+            flag = file_flags[flag_number]
+            if flag is not None:
+                entries[flag, aspect, width, LOD_LEVELS[level_index]] = \
+                    (error, shapes, vertices, start)
+        self.data = memoryview(data)
+        return entries
+
+    def close(self):
+        with self._lock:
+            self.entries = None
+            self.colors = None
+            # The mapping is closed once the compiled flags using it are
+            # garbage collected
+            self.data = None
+
+    def lookup(self, flag, aspect, width, level):
+        if self.entries is None:
+            self.open()
+        if self.settings != geometry_settings():
+            return None
+        return self.entries.get((flag, aspect, width, level))
+
+    # Compiled flag replayed from the file arrays (no copy), or None
+    def compiled(self, flag, aspect, width, level):
+        entry = self.lookup(flag, aspect, width, level)
+        if entry is None:
+            return None
+        _, shapes, vertices, position = entry
+        data = self.data
+        sizes = (shapes * 4, (shapes + 1) * 8, vertices * 16, shapes * 24)
+        arrays = []
+        for size, typecode in zip(sizes, "Iqdd"):
+            arrays.append(data[position:position + size].cast(typecode))
+            position += align8(size)
+        colors = self.colors
+        return CompiledFlag.from_arrays([colors[i] for i in arrays[0]],
+                                        *arrays[1:])
+
+    def lod_error(self, flag, aspect, width, level):
+        entry = self.lookup(flag, aspect, width, level)
+        if entry is None or math.isnan(entry[0]):
+            return None
+        return entry[0]
+
+    # Forget the entries of a flag (its drawing function has changed)
+    def invalidate(self, flag):
+        if self.entries is None:
+            self.open()
+        for key in [k for k in self.entries if k[0] is flag]:
+            del self.entries[key]
+
+# Keys of the compiled flags used to draw the flags at the given widths
+# (with their ratio): the levels of detail checked by Flag.lod()
+def compiled_cache_keys(widths):
+    for flag in flags_dict.values():
+        for width in widths:
+            aspect = round(int(round(width * flag.ratio)) / width, 6)
+            level = lod_level(width)
+            for level in LOD_LEVELS[:LOD_LEVELS.index(level) + 1]:
+                yield flag, aspect, compile_width(width), level
+
+# Compile the flags & return the cache file data chunks
+def compiled_cache_chunks(keys):
+    flags = list(flags_dict.values())
+    colors = {}
+    entries = []
+    arrays = []
+    for flag, aspect, width, level in keys:
+        compiled = flag.compiled(aspect, width, level)
+        error = math.nan
+        if level != LOD_FULL:
+            error = flag.lod_error(level, width, width * aspect)
+        indexes = array('I', [colors.setdefault(color, len(colors))
+                              for color in compiled.colors])
+        entries.append([flags.index(flag), LOD_LEVELS.index(level), aspect,
+                        width, error, len(compiled),
+                        compiled.vertex_count()])
+        arrays.append((indexes, array('q', compiled.offsets),
+                       array('d', compiled.coords),
+                       array('d', compiled.anchors)))
+    metadata = json.dumps({'colors': list(colors),
+                           'flags': [f.drawing_func.__name__ for f in flags]
+                           }).encode('utf-8')
+    header = COMPILED_CACHE_HEADER.pack(
+        COMPILED_CACHE_MAGIC, COMPILED_CACHE_VERSION,
+        geometry_fingerprint().encode('ascii'), len(entries), len(metadata))
+    position = len(header) + len(metadata) + \
+        COMPILED_CACHE_ENTRY.size * len(entries)
+    yield header + metadata
+    start = align8(position)
+    for entry, entry_arrays in zip(entries, arrays):
+        entry.append(start)
+        start += sum(align8(len(a) * a.itemsize) for a in entry_arrays)
+        yield COMPILED_CACHE_ENTRY.pack(*entry)
+    yield bytes(align8(position) - position)
+    for entry_arrays in arrays:
+        for a in entry_arrays:
+            size = len(a) * a.itemsize
+            yield a.tobytes() + bytes(align8(size) - size)
+
+# Compile the flags of the given keys & write the cache file (the file is
+# replaced at once, processes using the previous file keep their mapping),
+# return False if it can not be written
+def write_compiled_cache(filename, keys):
+    # Note: the cache is only an optimization, so it is fine if it can not
+    # be written (read only directory...), the flags are then compiled in
+    # memory. The flags are only compiled once the file is created.
+    temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(temp_filename, 'wb') as fh:
+            for chunk in compiled_cache_chunks(keys):
+                fh.write(chunk)
+            size = fh.tell()
+        os.replace(temp_filename, filename)
+    except OSError as error:
+        debug("Compiled flags cache not written:", error)
+        with contextlib.suppress(OSError):
+            os.remove(temp_filename)
+        return False
+    debug("Compiled flags cache:", len(keys), "entries,", size, "bytes")
+    return True
+
+# Make sure the cache file has the compiled flags of the given widths (the
+# default export sizes by default): the file is rebuilt if it is out of
+# date (the flags or the settings have changed), the missing widths are
+# added else. Return True if the file is up to date, False if it could not
+# be written.
+def ensure_compiled_cache(widths=None, cache=None):
+    cache = cache or compiled_cache
+    keys = list(dict.fromkeys(compiled_cache_keys(
+        widths or DEFAULT_EXPORT_SIZES)))
+    missing = [key for key in keys if cache.lookup(*key) is None]
+    if not missing:
+        return True
+    # The entries of a valid file are replayed (no compilation)
+    keys = list(cache.entries) + missing
+    written = write_compiled_cache(cache.filename, keys)
+    cache.close()  # The new file is opened on the next lookup
+    return written
+
+compiled_cache = CompiledCacheFile(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), COMPILED_CACHE_FILENAME))
+
+
+### LAYOUT ###
+
+# Placement of the flags on a page, computed from the flags ratios, the
+# labels height and the window size. Layouts are pure computations (no
+# drawing) cached per window size, flags & options, so drawing a page again
+# or a re-layout after a resize is cheap.
+
+layout_cache = GeometryCache(LAYOUT_CACHE_SIZE)
+
+class Layout(object):
+    def __init__(self, cells, columns, rows):
+        self.cells = cells  # [(flag, x, y, width, height)], top left corners
+        self.columns = columns
+        self.rows = rows
+
+# Number of columns of flags of the given width: as many as possible, minus
+# one if the flags would be closer than border. Return (columns, spacing).
+def grid_columns(available_width, width, border):
+    columns = max(1, int(available_width / width))
+    spacing = available_width - columns * width
+    if columns > 1 and spacing < border * (columns - 1):
+        columns -= 1
+    if columns == 1:
+        return 1, border
+    return columns, (available_width - columns * width) / (columns - 1)
+
+# Uniform grid: same width for all the flags, the height of a row is the
+# height of its tallest flag. Return the cells relative to the top left
+# corner and the rows.
+def layout_grid(flags, available_width, width, border, label_height, ratio):
+    columns, spacing = grid_columns(available_width, width, border)
+    cells = []
+    y = 0
+    for first in range(0, len(flags), columns):
+        row = flags[first:first + columns]
+        heights = [width * (flag.ratio if ratio else FLAG_DEFAULT_RATIO)
+                   for flag in row]
+        for i, (flag, height) in enumerate(zip(row, heights)):
+            cells.append((flag, i * (width + spacing), y, width, height))
+        y -= max(heights) + max(spacing, label_height)
+    return cells, columns
+
+# Justified rows: the flags of a row have the same height, then the rows
+# (except the last one) are scaled to fill exactly the available width
+def layout_justified(flags, available_width, width, border, label_height,
+                     ratio):
+    height = width * FLAG_DEFAULT_RATIO
+    rows = []
+    row = []
+    row_width = 0
+    for flag in flags:
+        w = height / (flag.ratio if ratio else FLAG_DEFAULT_RATIO)
+        if row and row_width + border + w > available_width:
+            rows.append(row)
+            row = []
+        row_width = (row_width + border + w) if row else w
+        row.append((flag, w))
+    if row:
+        rows.append(row)
+    cells = []
+    y = 0
+    for i, row in enumerate(rows):
+        gaps = border * (len(row) - 1)
+        scale = 1
+        if i < len(rows) - 1:  # The last row is not scaled
+            scale = (available_width - gaps) / sum(w for flag, w in row)
+        x = 0
+        for flag, w in row:
+            cells.append((flag, x, y, w * scale, height * scale))
+            x += w * scale + border
+        y -= height * scale + max(border, label_height)
+    return cells, max((len(row) for row in rows), default=0)
+
+layout_strategies = {
+    'grid': layout_grid,
+    'justified': layout_justified,
+}
+
+# Layout of the flags in a window, with a border around the page
+def layout_flags(flags, window_width, window_height, width, border,
+                 labels=False, ratio=False, strategy=DEFAULT_LAYOUT_STRATEGY):
+    flags = tuple(flags)
+    def compute():
+        x_start = -(window_width / 2) + border
+        y_start = (window_height / 2) - border
+        cells, columns = layout_strategies[strategy](
+            flags, window_width - 2 * border, width, border,
+            LAYOUT_LABEL_HEIGHT if labels else 0, ratio)
+        cells = [(flag, x_start + x, y_start + y, w, h)
+                 for flag, x, y, w, h in cells]
+        rows = len(set(y for flag, x, y, w, h in cells))
+        debug("Layout", strategy, columns, "columns", rows, "rows")
+        return Layout(cells, columns, rows)
+    return layout_cache.get((window_width, window_height, flags, width, border,
+                             labels, ratio, strategy), compute)
+
+
+def draw_all_flags(width, border, country_names=False, ratio=False,
+                   strategy=DEFAULT_LAYOUT_STRATEGY):
+    for _ in draw_all_flags_steps(width, border, country_names, ratio,
+                                  strategy):
+        pass
+
+# Same as draw_all_flags() but step by step: this generator yields after
+# each flag (see render_in_background())
+def draw_all_flags_steps(width, border, country_names=False, ratio=False,
+                         strategy=DEFAULT_LAYOUT_STRATEGY):
+    global drawn_page
+    window_size = (screen.window_width(), screen.window_height())
+    layout = layout_flags(flags_dict.values(), *window_size, width, border,
+                          country_names, ratio, strategy)
+    # With the canvas backend, the flags are tagged canvas items which can
+    # be moved & scaled when the window is resized (see resize_page())
+    canvas_items = (context_fast_draw() and context_backend() == "canvas"
+                    and current_recorder() is None)
+    page = DrawnPage(layout, window_size, canvas_items,
+                     (width, border, country_names, ratio, strategy))
+    drawn_page = page
+    for i, (flag, x, y, w, h) in enumerate(layout.cells):
+        if canvas_items:
+            draw_flag_items(flag, x, y, w, h, country_names, (page.tag(i),))
+            page.cells_drawn.append((flag.lod(w, h), compile_width(w)))
         else:
-            h = width * FLAG_DEFAULT_RATIO
-            flag.draw(x, y, width, h)
-        # Draw the flag border
-        ct.color(FLAG_BORDER_COL) # TODO find a better way for color config
-        rectangle(x, y, width, h)
-        # Add the flag name
-        if country_names:
-            ct.penup()
-            ct.goto(x + width / 2, y)
-            name = get_country_name(flag.country_code)
-            ct.write(name, align="center", font=("Arial", 11, "normal"))
-        # Next flag
-        x += width + border_inside
-        if x > (window_width / 2) - border - width:
-            x = x_start
-            y -= width * 2/3 + border_inside # TODO 2/3 here is not so nice
+            flag.draw(x, y, w, h)
+            # Draw the flag border
+            ct.color(FLAG_BORDER_COL) # TODO find a better way for color config
+            rectangle(x, y, w, h)
+            # Add the flag name
+            if country_names:
+                ct.penup()
+                ct.goto(x + w / 2, y)
+                name = get_country_name(flag.country_code)
+                ct.write(name, align="center", font=LABEL_FONT)
+        yield flag
+
+
+### COUNTRY NAMES ###
+
+# Country names of all the languages, loaded lazily (once per language) and
+# indexed by "collation key" (lower case without accents, see
+# collation_key()) for sorting and search as you type.
+
+# Sort & search key of a country name, so "états-unis" is found with "Etats"
+# and sorted with the "E" countries
+def collation_key(name):
+    return strip_accents(name).casefold()
+
+# Country names of one language, with their collation keys sorted for the
+# searches
+class CountryNames(object):
+    def __init__(self, language, names, keys=None):
+        self.language = language
+        self.names = names  # {country code: name}
+        if keys is None:
+            keys = {code: collation_key(name) for code, name in names.items()}
+        self.keys = keys  # {country code: collation key}
+        self.index = sorted((key, code) for code, key in keys.items())
+        self.index_keys = [key for key, code in self.index]
+
+    def get(self, code, default=""):
+        return self.names.get(code, default)
+
+    def collation_key(self, code):
+        return self.keys.get(code, "")
+
+    # Country codes sorted by country name
+    def sorted_codes(self):
+        return [code for key, code in self.index]
+
+    # Country codes of the names starting with text (sorted by name)
+    def search_prefix(self, text):
+        key = collation_key(text)
+        first = bisect.bisect_left(self.index_keys, key)
+        last = bisect.bisect_left(self.index_keys, key + "\U0010ffff", first)
+        return [code for key, code in self.index[first:last]]
+
+    # Country codes of the names containing text (sorted by name)
+    def search(self, text):
+        key = collation_key(text)
+        return [code for name_key, code in self.index if key in name_key]
+
+# Store of the country names of all the available languages, with a binary
+# cache file of the parsed files (the cache entry of a language is used
+# only if its text file has not been modified since)
+class CountryNamesStore(object):
+    def __init__(self, directory, basename=COUNTRY_NAMES_FILENAME,
+                 cache_filename=COUNTRY_NAMES_CACHE_FILENAME):
+        self.directory = directory
+        self.basename = basename
+        self.cache_filename = cache_filename
+        self.cache_path = os.path.join(directory, cache_filename)
+        self.cache = None  # {language: (mtime, names, keys)}
+        self.languages_names = dict()  # {language: CountryNames}
+
+    def filename(self, language):
+        return os.path.join(self.directory, self.basename + '.' + language)
+
+    # Languages having a country names file (not the cache file, nor the
+    # temporary files of an interrupted write_cache())
+    def languages(self):
+        prefix = self.basename + '.'
+        return sorted(f[len(prefix):] for f in os.listdir(self.directory)
+                      if f.startswith(prefix) and
+                      f != self.cache_filename and
+                      not f.startswith(self.cache_filename + '.'))
+
+    # Country names of a language (FileNotFoundError if not available)
+    def get(self, language):
+        names = self.languages_names.get(language)
+        if names is None:
+            names = self.load(language)
+            self.languages_names[language] = names
+        return names
+
+    def load_all(self):
+        return [self.get(language) for language in self.languages()]
+
+    def load(self, language):
+        filename = self.filename(language)
+        mtime = os.stat(filename).st_mtime_ns
+        if self.cache is None:
+            self.cache = self.read_cache()
+        entry = self.cache.get(language)
+        if entry is not None and entry[0] == mtime:
+            return CountryNames(language, entry[1], entry[2])
+        names = CountryNames(language, self.parse(filename))
+        self.cache[language] = (mtime, names.names, names.keys)
+        self.write_cache()
+        return names
+
+    @staticmethod
+    def parse(filename):
+        names = dict()
+        with open(filename, encoding='utf-8') as fh:
+            for line in fh:
+                if line.startswith("#"): # Ignore commented lines
+                    continue
+                code, country_name = line.rstrip().split(";")
+                names[int(code)] = country_name
+        return names
+
+    # The cache is a json file: {language: {"mtime": mtime, "names":
+    # [[code, name, collation key]...]}}
+    def read_cache(self):
+        cache = dict()
+        try:
+            with open(self.cache_path, encoding='utf-8') as fh:
+                for language, entry in json.load(fh).items():
+                    names = {code: name for code, name, _ in entry['names']}
+                    keys = {code: key for code, _, key in entry['names']}
+                    cache[language] = (entry['mtime'], names, keys)
+        except Exception: # No cache yet, old or damaged cache...
+            return dict()
+        return cache
+
+    # Note: the cache is only an optimization, so it is fine if it can not
+    # be written (read only directory...)
+    def write_cache(self):
+        cache = {language: {'mtime': mtime,
+                            'names': [[code, name, keys[code]]
+                                      for code, name in names.items()]}
+                 for language, (mtime, names, keys) in self.cache.items()}
+        tmp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fh:
+                json.dump(cache, fh, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as error:
+            debug("Country names cache not written:", error)
+
+country_names_store = CountryNamesStore(
+    os.path.dirname(os.path.abspath(__file__)))
+current_country_names = None  # CountryNames of the current language
 
 # Helper function to avoid to test everytime if the country_names
 # dictionnary is empty or a country code is missing
 def get_country_name(code):
-    global country_names
-    name = ""
-    if code in country_names:
-        name = country_names[code]
-
-    return name
+    return country_names.get(code, "")
 
+# Switch the country names to another language (instant if the language has
+# already been loaded)
 def load_country_names(language):
     global country_names
-    country_names.clear()
-    filename = COUNTRY_NAMES_FILENAME + '.' + language
+    global current_country_names
     try:
-        with open(filename) as fh:
-            for line in fh:
-                if line.startswith("#"): # Ignore commented lines
-                    continue
-                code, country_name = line.rstrip().split(";")
-                country_names[int(code)] = country_name
-
+        current_country_names = country_names_store.get(language)
     except FileNotFoundError as fnf_error:
         print(fnf_error)
         return False
-    except AssertionError as error:
+    except ValueError as error: # Bad line in the file
         print(error)
         return False
-
-    #print(country_names)
+    country_names = current_country_names.names
+    if language not in flag_index.by_name:
+        flag_index.add_language(current_country_names)
     return True
 
+# Flags metadata, no drawing & no display needed (country names are only
+# available after load_country_names())
+def flags_metadata():
+    return [{'flag': func.__name__, 'country_code': flag.country_code,
+             'alpha2': flag_index.codes(flag)[0],
+             'alpha3': flag_index.codes(flag)[1],
+             'ratio': flag.ratio,
+             'country_name': get_country_name(flag.country_code)}
+            for func, flag in flags_dict.items()]
+
 
 ### EVENTS MANAGEMENT ###
 
 def my_exit():
     print("Bye")
+    cancel_rendering()
+    stop_gallery()
     screen.bye()
 
 def my_exit_mouse(x, y):
@@ -695,6 +2689,7 @@ def install_event_management():
 
     screen.onscreenclick(my_onscreenclick, btn=MOUSE_BUTTON_NORMAL)
     screen.onkeypress(my_onkeypress)
+    screen.getcanvas().bind("<Configure>", on_configure, add="+")
     global my_screenclicked
     global my_keypressed
     my_screenclicked = False
@@ -706,9 +2701,14 @@ def install_event_management():
 ### SCREEN UPDATE HELPERS ###
 
 # TODO rename me + test all parameters
-def update_configure(fast=True, speed=2):
+def update_configure(fast=True, speed=2, backend=None):
     global fast_draw
+    global draw_backend
     fast_draw = fast
+    if backend is not None:
+        if backend not in ("turtle", "canvas"):
+            raise ValueError("Unknown draw backend: " + backend)
+        draw_backend = backend
     if fast_draw:
         # Set speed to max   # TODO useful as we use tracer(0)?
         ct.speed(0)
@@ -727,6 +2727,420 @@ def update_do():
         screen.update()
 
 
+### COOPERATIVE RENDERING ###
+
+# Long drawings (all the flags of a page...) are split in steps: generators
+# yielding after each flag. The steps are run by chunks from the Tk event
+# loop: a chunk runs steps during RENDER_FRAME_BUDGET seconds, then the
+# screen is updated (progressive display) and the next chunk is scheduled
+# with screen.ontimer(), so key presses & mouse clicks are handled between
+# the chunks instead of waiting for the end of the drawing.
+class RenderTask(object):
+    def __init__(self, steps, budget=RENDER_FRAME_BUDGET, on_done=None):
+        self.steps = steps
+        self.budget = budget
+        self.on_done = on_done
+        self.cancelled = False
+        self.done = False
+        self.chunks = 0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        screen.ontimer(self.run_chunk, RENDER_CHUNK_DELAY)
+        return self
+
+    def run_chunk(self):
+        if self.cancelled:
+            return
+        deadline = time.perf_counter() + self.budget
+        try:
+            next(self.steps)
+            while time.perf_counter() < deadline:
+                next(self.steps)
+        except StopIteration:
+            self.done = True
+        except Exception:
+            if self.cancelled: # Exit while drawing (the screen is closed)
+                return
+            raise
+        self.chunks += 1
+        update_do()
+        if self.cancelled: # Exit during the screen update
+            return
+        if self.chunks == 1:
+            debug("First paint after {:.1f} ms".format(
+                (time.perf_counter() - self.start_time) * 1000))
+        if not self.done:
+            screen.ontimer(self.run_chunk, RENDER_CHUNK_DELAY)
+            return
+        debug("Rendering done in {:.1f} ms, {} chunks".format(
+            (time.perf_counter() - self.start_time) * 1000, self.chunks))
+        if self.on_done is not None:
+            self.on_done()
+
+    # Stop the rendering, the chunk already scheduled will do nothing
+    def cancel(self):
+        self.cancelled = True
+        try:
+            self.steps.close()
+        except ValueError: # Cancelled from a step (events handled by turtle)
+            pass
+
+render_task = None
+
+# Start rendering steps from the event loop (the current rendering, if any,
+# is cancelled first)
+def render_in_background(steps, on_done=None):
+    global render_task
+    cancel_rendering()
+    render_task = RenderTask(steps, on_done=on_done).start()
+    return render_task
+
+def cancel_rendering():
+    global render_task
+    if render_task is not None:
+        render_task.cancel()
+        render_task = None
+
+
+### GALLERY MODES ###
+
+# In the gallery modes, the flags are drawn directly as canvas items (like
+# the "canvas" draw backend) tagged per page or per flag, so they can be
+# hidden, shown, moved & deleted without drawing them again. Only the
+# visible flags (and the next page) are drawn.
+
+GALLERY_TAG = "gallery"
+
+gallery = None  # Current gallery (PagedGallery or ScrollingGallery)
+
+# Flags page by page: the pages are cut from the layout of all the flags
+# (whole rows only). The current page is drawn first, then the next &
+# previous ones are pre-rendered hidden, so changing page only changes the
+# state of the canvas items.
+class PagedGallery(object):
+    def __init__(self, flags, width, border, labels=True, ratio=False,
+                 strategy=DEFAULT_LAYOUT_STRATEGY):
+        self.flags = tuple(flags)
+        self.options = (width, border, labels, ratio, strategy)
+        self.labels = labels
+        self.current = None
+        self.drawn = dict()  # {page: indexes of the cells already drawn}
+        self.window_size = None
+        self.pages = self.layout_pages()
+
+    def layout_pages(self):
+        self.window_size = (screen.window_width(), screen.window_height())
+        width, border, labels, ratio, strategy = self.options
+        return self.paginate(layout_flags(self.flags, *self.window_size,
+                                          width, border, labels, ratio,
+                                          strategy), border)
+
+    @staticmethod
+    def paginate(layout, border):
+        top = screen.window_height() / 2 - border
+        bottom = -top
+        rows = collections.OrderedDict()
+        for cell in layout.cells:
+            rows.setdefault(cell[2], []).append(cell)
+        pages = []
+        offset = 0
+        for y, row in rows.items():
+            row_bottom = min(y - h for flag, x, y, w, h in row)
+            if not pages or row_bottom + offset < bottom:
+                pages.append([])
+                offset = top - y
+            pages[-1].extend((flag, x, y + offset, w, h)
+                             for flag, x, y, w, h in row)
+        return pages
+
+    @staticmethod
+    def tag(page):
+        return "page{}".format(page)
+
+    def page_steps(self, page):
+        if not 0 <= page < len(self.pages):
+            return
+        tag = self.tag(page)
+        drawn = self.drawn.setdefault(page, set())
+        canvas = screen.getcanvas()
+        for i, (flag, x, y, w, h) in enumerate(self.pages[page]):
+            if i in drawn:
+                continue
+            draw_flag_items(flag, x, y, w, h, self.labels, (GALLERY_TAG, tag))
+            if page != self.current:  # Pre-rendering
+                canvas.itemconfigure(tag, state="hidden")
+            drawn.add(i)
+            yield flag
+
+    def render_steps(self, page):
+        yield from self.page_steps(page)
+        yield from self.page_steps(page + 1)
+        yield from self.page_steps(page - 1)
+
+    def show_page(self, page):
+        page = max(0, min(page, len(self.pages) - 1))
+        if page == self.current:
+            return
+        canvas = screen.getcanvas()
+        if self.current is not None:
+            canvas.itemconfigure(self.tag(self.current), state="hidden")
+        self.current = page
+        canvas.itemconfigure(self.tag(page), state="normal")
+        # Forget the pages far from the current one
+        for other in list(self.drawn):
+            if abs(other - page) > GALLERY_PAGES_KEPT:
+                canvas.delete(self.tag(other))
+                del self.drawn[other]
+        render_in_background(self.render_steps(page))
+        debug("Page", page + 1, "/", len(self.pages))
+
+    def next_page(self):
+        self.show_page(self.current + 1)
+
+    def previous_page(self):
+        self.show_page(self.current - 1)
+
+    # New pages for the new window size, showing the page of the first flag
+    # of the current page
+    def resize(self):
+        if self.window_size == (screen.window_width(),
+                                screen.window_height()):
+            return
+        first = self.pages[self.current][0][0]
+        screen.getcanvas().delete(GALLERY_TAG)
+        self.drawn.clear()
+        self.current = None
+        self.pages = self.layout_pages()
+        self.show_page(next(i for i, page in enumerate(self.pages)
+                            if any(cell[0] is first for cell in page)))
+
+    def start(self):
+        for key in ("Right", "Down", "Next", "space"):
+            screen.onkey(self.next_page, key)
+        for key in ("Left", "Up", "Prior", "BackSpace"):
+            screen.onkey(self.previous_page, key)
+        self.show_page(0)
+
+    def stop(self):
+        pass
+
+# Strip of small flags scrolling horizontally (speed in pixels per second,
+# negative to scroll to the right). The flags are in numbered slots, the
+# slot k shows flags[k % len(flags)]: only the visible slots are drawn,
+# then they are moved with canvas.move() and deleted when they leave the
+# window.
+class ScrollStrip(object):
+    def __init__(self, flags, y, width, height, spacing, speed, tag):
+        self.flags = flags
+        self.y = y
+        self.width = width
+        self.height = height
+        self.pitch = width + spacing
+        self.speed = speed
+        self.tag = tag
+        self.offset = 0.0  # Scrolled distance
+        self.slots = dict()  # {slot: tag} of the drawn flags
+        self.left = -screen.window_width() / 2
+        self.right = screen.window_width() / 2
+
+    def slot_x(self, slot):
+        return self.left + slot * self.pitch - self.offset
+
+    # Slot at the given x coordinate
+    def slot_at(self, x):
+        return math.floor((x - self.left + self.offset) / self.pitch)
+
+    def scroll(self, seconds):
+        dx = self.speed * seconds
+        self.offset += dx
+        canvas = screen.getcanvas()
+        canvas.move(self.tag, -dx * screen.xscale, 0)
+        first = self.slot_at(self.left - self.width)
+        last = self.slot_at(self.right)
+        for slot in [s for s in self.slots if not first <= s <= last]:
+            canvas.delete(self.slots.pop(slot))
+        for slot in range(first, last + 1):
+            if slot not in self.slots:
+                tag = "{}_{}".format(self.tag, slot)
+                draw_flag_items(self.flags[slot % len(self.flags)],
+                                self.slot_x(slot), self.y, self.width,
+                                self.height, False,
+                                (GALLERY_TAG, self.tag, tag))
+                self.slots[slot] = tag
+
+class ScrollingGallery(object):
+    def __init__(self, flags, border, labels=True):
+        self.flags = list(flags)
+        self.border = border
+        self.labels = labels
+        self.strips = []
+        self.setup()
+        self.last_time = None
+        self.stopped = False
+
+    # Strips & center flag sizes for the window size (the scrolled distance
+    # is kept when the window is resized)
+    def setup(self):
+        border = self.border
+        self.window_size = (screen.window_width(), screen.window_height())
+        window_width, window_height = self.window_size
+        old_strips = self.strips
+        height = window_height * 0.15
+        width = height / FLAG_DEFAULT_RATIO
+        top = window_height / 2 - border
+        self.strips = [
+            ScrollStrip(self.flags, top, width, height, border,
+                        SCROLL_SPEED, "scroll_top"),
+            ScrollStrip(self.flags[::-1], -top + height, width, height,
+                        border, -SCROLL_SPEED, "scroll_bottom")]
+        # Big flag in the center: the flag in the center of the top strip,
+        # in the space left between the strips (with its label above & a
+        # border around, the flag is centered vertically)
+        label = LAYOUT_LABEL_HEIGHT if self.labels else 0
+        space = window_height - 2 * border - 2 * height
+        self.center_height = max(1, space - 2 * (label + border))
+        self.center_width = min(window_width * 0.6,
+                                self.center_height / FLAG_DEFAULT_RATIO)
+        self.center_slot = None
+        for old, strip in zip(old_strips, self.strips):
+            strip.offset = old.offset * strip.pitch / old.pitch
+
+    def resize(self):
+        if self.window_size != (screen.window_width(),
+                                screen.window_height()):
+            screen.getcanvas().delete(GALLERY_TAG)
+            self.setup()
+
+    def update_center(self):
+        strip = self.strips[0]
+        slot = strip.slot_at(0)
+        if slot == self.center_slot:
+            return
+        self.center_slot = slot
+        flag = self.flags[slot % len(self.flags)]
+        w = self.center_width
+        h = min(self.center_height, w * flag.ratio)
+        screen.getcanvas().delete("scroll_center")
+        draw_flag_items(flag, -w / 2, h / 2, w, h, self.labels,
+                        (GALLERY_TAG, "scroll_center"))
+
+    # One frame: the scrolling depends on the elapsed time, so the speed is
+    # the same even when some frames are late
+    def tick(self):
+        if self.stopped:
+            return
+        now = time.perf_counter()
+        seconds = min(now - self.last_time, 0.25)
+        self.last_time = now
+        for strip in self.strips:
+            strip.scroll(seconds)
+        self.update_center()
+        update_do()
+        spent = (time.perf_counter() - now) * 1000
+        screen.ontimer(self.tick, max(1, int(1000 / SCROLL_FPS - spent)))
+
+    def start(self):
+        self.last_time = time.perf_counter()
+        self.tick()
+
+    def stop(self):
+        self.stopped = True
+
+def start_gallery(new_gallery):
+    global gallery
+    stop_gallery()
+    gallery = new_gallery
+    gallery.start()
+
+def stop_gallery():
+    global gallery
+    if gallery is not None:
+        gallery.stop()
+        gallery = None
+
+
+### WINDOW RESIZING ###
+
+# When the window is resized, the page drawn by draw_all_flags_steps() is
+# laid out again (cached layout math only) and the canvas items of each
+# flag are scaled & moved to their new cell with canvas.scale() and
+# canvas.move(). A flag is drawn again only if its level of detail changes
+# or if it gets bigger than the width its geometry was compiled for. The
+# whole page is drawn again only if it was not drawn with canvas items
+# (turtle backend, animated mode) or if it was not completely drawn yet.
+
+# Page drawn by draw_all_flags_steps()
+class DrawnPage(object):
+    def __init__(self, layout, window_size, canvas_items, options):
+        self.layout = layout
+        self.window_size = window_size
+        self.canvas_items = canvas_items
+        self.options = options  # draw_all_flags_steps() parameters
+        # [(level of detail, compile width)] of the drawn canvas items
+        self.cells_drawn = []
+
+    @staticmethod
+    def tag(cell):
+        return "cell{}".format(cell)
+
+drawn_page = None
+resize_events = 0
+
+def on_configure(event):
+    #pylint: disable=unused-argument
+    global resize_events
+    resize_events += 1
+    count = resize_events
+    # Only handle the last event of a series (when the window is resized
+    # with the mouse, there are many events)
+    def resize_if_last():
+        if count == resize_events:
+            resize_page()
+    screen.ontimer(resize_if_last, RESIZE_DELAY)
+
+def resize_page():
+    if gallery is not None:
+        gallery.resize()
+        return
+    page = drawn_page
+    window_size = (screen.window_width(), screen.window_height())
+    if page is None or window_size == page.window_size:
+        return
+    width, border, labels, ratio, strategy = page.options
+    if not page.canvas_items or \
+       len(page.cells_drawn) < len(page.layout.cells):
+        debug("Resize", window_size, "full redraw")
+        clear_drawings()
+        render_in_background(draw_all_flags_steps(*page.options))
+        return
+    layout = layout_flags(flags_dict.values(), *window_size, width, border,
+                          labels, ratio, strategy)
+    canvas = screen.getcanvas()
+    redrawn = 0
+    for i, (old, new) in enumerate(zip(page.layout.cells, layout.cells)):
+        flag, x, y, w, h = new
+        x0, y0, w0, h0 = old[1:]
+        tag = page.tag(i)
+        level, drawn_width = page.cells_drawn[i]
+        if flag.lod(w, h) != level or compile_width(w) > drawn_width:
+            canvas.delete(tag)
+            draw_flag_items(flag, x, y, w, h, labels, (tag,))
+            page.cells_drawn[i] = (flag.lod(w, h), compile_width(w))
+            redrawn += 1
+            continue
+        old_x, old_y = canvas_point(x0, y0)
+        new_x, new_y = canvas_point(x, y)
+        if (w, h) != (w0, h0):
+            canvas.scale(tag, old_x, old_y, w / w0, h / h0)
+        canvas.move(tag, new_x - old_x, new_y - old_y)
+    page.layout = layout
+    page.window_size = window_size
+    update_do()
+    debug("Resize", window_size, redrawn, "flags redrawn")
+
+
 ### TEST HELPERS ###
 
 def test_primitives():
@@ -780,8 +3194,7 @@ def screenshot(filename="screenshot", need_penup=True):
         ct.penup()
     filename += ".eps"
     screen.getcanvas().postscript(file=filename, colormode='color')
-    if DEBUG:
-        print("Screenshot done, filename =", filename)
+    debug("Screenshot done, filename =", filename)
 
 def screenshot_all():
     for i in flags_dict:
@@ -789,73 +3202,1007 @@ def screenshot_all():
         test_flag_class(drawing_func, True)
         screen.update()
         screenshot(drawing_func.__name__)
-        ct.clear()
-
-# Hereafter linux commands used to convert the screenshot eps files
-# to a webm video (better than animated gif)
-# 1) convert eps to png with inkscape
-# 2-webm) convert png to webm animation with ffmpeg
-# 2-gif) convert png to gif animation with ImageMagick & gifsicle
-# export flag=flag_South_Korea
-# export fps=20
-# export width=416
-# for n in `ls $flag*.eps | cut -f1 -d'.'`; do inkscape $n.eps -o $n.png -y 255 -w $width; done
-# ffmpeg -framerate $fps -i $flag%04d.png $flag.webm
-# Note: if you prefer a gif file, instead the ffmpeg command, use:
-# convert -loop 0 -delay 1x$fps -layers Optimize $flag*.png $flag.gif
-# Note: if you want to optimize the gif animation, use:
-# gifsicle -O3 --colors 256 $flag.gif -o $flag_optimized.gif
-
-
-screenshot_anim_running = False
-screenshot_anim_filename = ""
-screenshot_anim_fps = DEFAULT_SCREENSHOT_ANIM_FPS
-
-def screenshot_anim_play(counter=[0]):
-    counter[0] += 1
-    filename = screenshot_anim_filename + "{0:04d}".format(counter[0])
-    screenshot(filename, False)
-    fps = screenshot_anim_fps
-    if screenshot_anim_running:
-        screen.ontimer(screenshot_anim_play, int(1000 / fps))
-
-def screenshot_anim_start(width, height, filename, fps=10, speed=2):
-    global screenshot_anim_running
-    global screenshot_anim_filename
-    global screenshot_anim_fps
-    if DEBUG:
-        print(f"screenshot_anim_start({width}, {height}, {filename}, "
-              f"fps={fps}, speed={speed})")
-    screen.setup(width, height)
-    ct.speed(speed)
-    ct.showturtle() # better to see the turtle moving too :-)
-    screen.tracer(True)
-    screenshot_anim_running = True
-    screenshot_anim_filename = filename
-    screenshot_anim_fps = fps
-    screenshot_anim_play()
-
-def screenshot_anim_stop():
-    global screenshot_anim_running
-    screenshot_anim_running = False
-    # Wait a short while to be sure last image has been saved
-    # and to see a longer time the finale result
-    time.sleep(3)
-    if DEBUG:
-        print("screenshot_anim_stop()")
+        clear_drawings()
+
+# Headless screenshots: render a flag directly into a png file, no display
+# needed. The flag is drawn at the pixel size (so circles get the same
+# number of segments than on the screen).
+def flag_png(flag, filename, width, height=None):
+    if height is None:
+        height = int(round(width * flag.ratio))
+    items = flag.record(0, 0, width, height)
+    pixels = rasterize(items, 0, 0, width, height, width, height)
+    write_png(filename, width, height, pixels)
+    debug("Screenshot done, filename =", filename)
+
+# Headless render target: a Recorder whose drawings are rasterized in a
+# pixel_width x pixel_height image of the (x, y, width, height) area
+class RasterTarget(Recorder):
+    def __init__(self, x, y, width, height, pixel_width=None,
+                 pixel_height=None, background='white'):
+        super().__init__()
+        self.area = (x, y, width, height)
+        self.pixel_width = pixel_width or int(round(width))
+        self.pixel_height = pixel_height or int(round(height))
+        self.background = background
+
+    def pixels(self):
+        return rasterize(self.items, *self.area, self.pixel_width,
+                         self.pixel_height, self.background)
+
+    def png(self):
+        return encode_png(self.pixel_width, self.pixel_height, self.pixels())
+
+# Render a flag to png (bytes), without using any global state: this can
+# be called from several threads at the same time (see render_pngs())
+def render_png(flag, width, height=None):
+    if height is None:
+        height = int(round(width * flag.ratio))
+    target = RasterTarget(0, 0, width, height)
+    flag.draw(0, 0, width, height, RenderContext(target, fast=True))
+    return target.png()
+
+# Render (flag, width) couples to png in a pool of threads, return the png
+# files data in the same order
+def render_pngs(renders, jobs=None):
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(lambda render: render_png(*render), renders))
+
+def screenshot_all_png(width=416):
+    for i in flags_dict:
+        flag = flags_dict[i]
+        flag_png(flag, flag.drawing_func.__name__ + ".png", width)
+
+# Animated screenshots: the flag is recorded then rasterized shape after
+# shape in memory, a frame is captured every shapes_per_frame shapes. The
+# frames only depend on the drawing progress (not on the machine load), so
+# the animation is the same on every run.
+def animation_frames(flag, width, height=None,
+                     shapes_per_frame=DEFAULT_SCREENSHOT_ANIM_SHAPES):
+    if height is None:
+        height = int(round(width * flag.ratio))
+    items = record(flag.drawing_func, 0, 0, width, height)
+    pixels = bytearray(bytes(color_rgb('white')) * (width * height))
+    frames = [bytes(pixels)]
+    for i, item in enumerate(items, 1):
+        points = [(px, -py) for px, py in item.points]
+        fill_polygon(pixels, width, height, points, color_rgb(item.color))
+        if i % shapes_per_frame == 0 or i == len(items):
+            frames.append(bytes(pixels))
+    return frames
+
+def flag_gif(flag, filename, width, height=None,
+             shapes_per_frame=DEFAULT_SCREENSHOT_ANIM_SHAPES,
+             fps=DEFAULT_SCREENSHOT_ANIM_FPS, end=DEFAULT_SCREENSHOT_ANIM_END):
+    if height is None:
+        height = int(round(width * flag.ratio))
+    frames = animation_frames(flag, width, height, shapes_per_frame)
+    delays = [int(round(100 / fps))] * len(frames)
+    delays[-1] = int(round(100 * end))
+    with open(filename, 'wb') as fh:
+        fh.write(encode_gif(width, height, frames, delays))
+    debug("Animated screenshot done, filename =", filename)
 
 def test_screenshot_anim(flag_function_name):
-    ratio = flags_dict[flag_function_name].ratio
-    screenshot_anim_start(416, 416 * ratio, flag_function_name.__name__,
-                          fps=DEFAULT_SCREENSHOT_ANIM_FPS,
-                          speed=DEFAULT_SCREENSHOT_ANIM_SPEED)
-    test_flag_class(flag_function_name, True)
-    screenshot_anim_stop()
+    flag_gif(flags_dict[flag_function_name],
+             flag_function_name.__name__ + ".gif", 416)
+
+
+### VECTOR EXPORT ###
+
+# Vector files written directly from the flags geometry with the standard
+# library only (no Tk canvas, no postscript conversion): svg files and one
+# pdf or postscript document with all the flags (one flag per page). The
+# files are written while the flags are drawn, page after page, so the
+# memory used does not depend on the number of flags.
+
+def hex_color(color):
+    return "#{:02x}{:02x}{:02x}".format(*color_rgb(color))
+
+# Vector geometry of a flag: display list in a width x height area with the
+# top left corner at (0, 0) (y axis going up, like Turtle)
+def vector_geometry(flag, width, height=None):
+    if height is None:
+        height = width * flag.ratio
+    return flag.record(0, 0, width, height, LOD_FULL), width, height
+
+def svg_document(flag, width, height=None):
+    if height is None:
+        height = int(round(width * flag.ratio))
+    record_width = max(width, VECTOR_RECORD_WIDTH)
+    items, rw, rh = vector_geometry(flag, record_width,
+                                    record_width * height / width)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+             'width="{}" height="{}" viewBox="0 0 {:.6g} {:.6g}">\n'
+             .format(width, height, rw, rh)]
+    for item in items:
+        points = " ".join("{:.2f},{:.2f}".format(x, -y)
+                          for x, y in item.points)
+        lines.append('<polygon points="{}" fill="{}"/>\n'.format(
+            points, hex_color(item.color)))
+    lines.append('</svg>\n')
+    return "".join(lines)
+
+def flag_svg(flag, filename, width, height=None):
+    with open(filename, 'w', encoding='utf-8') as fh:
+        fh.write(svg_document(flag, width, height))
+    debug("Svg export done, filename =", filename)
+
+# Text encodable with the standard PDF & PostScript fonts (latin-1),
+# escaped for a string
+def document_string(text):
+    text = text.encode('latin-1', 'replace').decode('latin-1')
+    text = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return "(" + text + ")"
+
+# Catalogue writers: pages of polygons, rectangles & texts in points, with
+# the origin at the bottom left corner of the page
+class PdfWriter(object):
+    def __init__(self, fh, page_width, page_height):
+        self.fh = fh
+        self.page_width = page_width
+        self.page_height = page_height
+        self.offsets = dict()  # {object number: position in the file}
+        self.pages = []  # page object numbers
+        self.next_object = 4  # 1 catalog, 2 pages tree, 3 font
+        self.content = None
+        self.position = 0
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def write(self, data):
+        self.fh.write(data)
+        self.position += len(data)
+
+    def write_object(self, number, data):
+        self.offsets[number] = self.position
+        self.write(b"%d 0 obj\n" % number + data + b"\nendobj\n")
+
+    def begin_page(self):
+        self.content = []
+
+    def polygon(self, points, rgb):
+        ops = ["{:.3f} {:.3f} {:.3f} rg".format(*(c / 255 for c in rgb))]
+        ops.append("{:.2f} {:.2f} m".format(*points[0]))
+        ops.extend("{:.2f} {:.2f} l".format(x, y) for x, y in points[1:])
+        ops.append("h f")
+        self.content.append("\n".join(ops))
+
+    def rectangle(self, x, y, width, height, line_width=0.5):
+        self.content.append("0 0 0 RG {} w {:.2f} {:.2f} {:.2f} {:.2f} re S"
+                            .format(line_width, x, y, width, height))
+
+    def text(self, x, y, text, size):
+        self.content.append("0 0 0 rg BT /F1 {} Tf {:.2f} {:.2f} Td {} Tj ET"
+                            .format(size, x, y, document_string(text)))
+
+    def end_page(self):
+        stream = zlib.compress("\n".join(self.content).encode('latin-1'))
+        self.content = None
+        content_number = self.next_object
+        page_number = self.next_object + 1
+        self.next_object += 2
+        self.write_object(content_number, b"<< /Length %d /Filter /FlateDecode"
+                          b" >>\nstream\n" % len(stream) + stream +
+                          b"\nendstream")
+        self.write_object(page_number, (
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {} {}] "
+            "/Resources << /Font << /F1 3 0 R >> >> /Contents {} 0 R >>"
+            .format(self.page_width, self.page_height, content_number))
+            .encode('ascii'))
+        self.pages.append(page_number)
+
+    def close(self):
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join("{} 0 R".format(page) for page in self.pages)
+        self.write_object(2, "<< /Type /Pages /Kids [{}] /Count {} >>"
+                          .format(kids, len(self.pages)).encode('ascii'))
+        self.write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont "
+                          b"/Helvetica /Encoding /WinAnsiEncoding >>")
+        xref = self.position
+        count = self.next_object
+        lines = [b"xref\n0 %d\n0000000000 65535 f \n" % count]
+        lines.extend(b"%010d 00000 n \n" % self.offsets[number]
+                     for number in range(1, count))
+        self.write(b"".join(lines))
+        self.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n"
+                   b"%%%%EOF\n" % (count, xref))
+
+class PostScriptWriter(object):
+    def __init__(self, fh, page_width, page_height):
+        self.fh = fh
+        self.pages = 0
+        self.write("%!PS-Adobe-3.0\n"
+                   "%%BoundingBox: 0 0 {} {}\n"
+                   "%%Pages: (atend)\n"
+                   "%%EndComments\n"
+                   "%%BeginProlog\n"
+                   "/Helvetica findfont dup length dict begin\n"
+                   "{{1 index /FID ne {{def}} {{pop pop}} ifelse}} forall\n"
+                   "/Encoding ISOLatin1Encoding def currentdict end\n"
+                   "/Helvetica-Latin1 exch definefont pop\n"
+                   "%%EndProlog\n".format(page_width, page_height))
+
+    def write(self, text):
+        self.fh.write(text.encode('latin-1'))
+
+    def begin_page(self):
+        self.pages += 1
+        self.write("%%Page: {0} {0}\n".format(self.pages))
+
+    def polygon(self, points, rgb):
+        ops = ["{:.3f} {:.3f} {:.3f} setrgbcolor newpath".format(
+            *(c / 255 for c in rgb))]
+        ops.append("{:.2f} {:.2f} moveto".format(*points[0]))
+        ops.extend("{:.2f} {:.2f} lineto".format(x, y) for x, y in points[1:])
+        ops.append("closepath fill\n")
+        self.write("\n".join(ops))
+
+    def rectangle(self, x, y, width, height, line_width=0.5):
+        self.write("0 setgray {} setlinewidth newpath {:.2f} {:.2f} moveto "
+                   "{:.2f} 0 rlineto 0 {:.2f} rlineto {:.2f} 0 rlineto "
+                   "closepath stroke\n".format(line_width, x, y, width,
+                                               height, -width))
+
+    def text(self, x, y, text, size):
+        self.write("0 setgray /Helvetica-Latin1 findfont {} scalefont setfont "
+                   "{:.2f} {:.2f} moveto {} show\n".format(
+                       size, x, y, document_string(text)))
+
+    def end_page(self):
+        self.write("showpage\n")
+
+    def close(self):
+        self.write("%%Trailer\n%%Pages: {}\n%%EOF\n".format(self.pages))
+
+catalogue_writers = {
+    '.pdf': PdfWriter,
+    '.ps': PostScriptWriter,
+}
+
+# Write all the flags (sorted by country name if the names are loaded) in
+# a pdf or postscript document (depending on the filename extension), one
+# flag per page with its name
+def write_catalogue(filename, flags=None):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in catalogue_writers:
+        raise ValueError("Unknown catalogue format: " + filename)
+    if flags is None:
+        flags = flag_index.sorted_by_name()
+    page_width, page_height = CATALOGUE_PAGE_SIZE
+    margin = CATALOGUE_MARGIN
+    with open(filename, 'wb') as fh:
+        writer = catalogue_writers[extension](fh, page_width, page_height)
+        for flag in flags:
+            width = page_width - 2 * margin
+            height = min(width * flag.ratio, page_height - 4 * margin)
+            width = height / flag.ratio
+            x = (page_width - width) / 2
+            y = page_height - 2 * margin  # flag top
+            items, rw, rh = vector_geometry(flag, VECTOR_RECORD_WIDTH)
+            scale = width / rw
+            writer.begin_page()
+            for item in items:
+                writer.polygon([(x + px * scale, y + py * scale)
+                                for px, py in item.points],
+                               color_rgb(item.color))
+            writer.rectangle(x, y - height, width, height)
+            name = get_country_name(flag.country_code)
+            writer.text(x, y - height - 2 * CATALOGUE_FONT_SIZE,
+                        "{} ({:03d})".format(name, flag.country_code).strip(),
+                        CATALOGUE_FONT_SIZE)
+            writer.end_page()
+        writer.close()
+    debug("Catalogue done, filename =", filename)
+
+
+### BATCH EXPORT ###
+
+# Export functions by file format: function(flag, filename, width)
+export_formats = {
+    'png': flag_png,
+    'gif': flag_gif,
+    'svg': flag_svg,
+}
+
+# Export one flag at one size in one format, return the manifest entry.
+# Note: this function is called in the worker processes, so it only gets
+# picklable parameters (the flag is given by its drawing function name).
+def export_flag(func_name, width, file_format, directory):
+    flag = flags_by_func_name()[func_name]
+    filename = os.path.join(directory, "{}_{}.{}".format(func_name, width,
+                                                         file_format))
+    start = time.perf_counter()
+    export_formats[file_format](flag, filename, width)
+    duration = time.perf_counter() - start
+    return {'flag': func_name, 'country_code': flag.country_code,
+            'width': width, 'format': file_format, 'filename': filename,
+            'seconds': round(duration, 6)}
+
+def flags_by_func_name():
+    return {func.__name__: flag for func, flag in flags_dict.items()}
+
+# Export all flags x sizes x formats in the given directory with a pool of
+# "jobs" processes (all cpus by default, jobs=1 exports in this process)
+# and write a json manifest with the output files & their timings.
+# The compiled flags cache file is updated first, so the workers replay it.
+def batch_export(directory, sizes=None, formats=None, jobs=None):
+    sizes = sizes or DEFAULT_EXPORT_SIZES
+    formats = formats or DEFAULT_EXPORT_FORMATS
+    for file_format in formats:
+        if file_format not in export_formats:
+            raise ValueError("Unknown export format: " + file_format)
+    jobs = jobs or os.cpu_count() or 1
+    os.makedirs(directory, exist_ok=True)
+    ensure_compiled_cache(sizes)
+    # Biggest images first, for a better load balancing between workers
+    tasks = [(func.__name__, width, file_format, directory)
+             for width in sorted(sizes, reverse=True)
+             for func in flags_dict
+             for file_format in formats]
+    start = time.perf_counter()
+    if jobs == 1:
+        entries = [export_flag(*task) for task in tasks]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            entries = list(executor.map(export_flag, *zip(*tasks),
+                                        chunksize=4))
+    duration = time.perf_counter() - start
+    entries.sort(key=lambda e: e['filename'])
+    manifest = {'jobs': jobs, 'sizes': sizes, 'formats': formats,
+                'files': entries, 'seconds': round(duration, 6)}
+    with open(os.path.join(directory, EXPORT_MANIFEST_FILENAME), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    debug("Exported", len(entries), "files in", directory,
+          "in {:.3f}s".format(duration))
+    return manifest
+
+
+### SPRITE ATLAS ###
+
+# All the flags at several widths packed in a few png images (atlases) with
+# a json index of their rectangles, so web pages load one image instead of
+# one per flag. The sprites are placed with the MaxRects algorithm (best
+# short side fit). The index keeps a hash of each sprite geometry: on the
+# next build only the sprites whose geometry changed are rasterized, the
+# others are copied from the previous atlases.
+
+# Rectangles packing in a bin: the free space is a list of (possibly
+# overlapping) maximal free rectangles
+class MaxRectsBin(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+        self.used_width = 0
+        self.used_height = 0
+
+    # Best position (score, x, y) of a width x height rectangle: the free
+    # rectangle leaving the shortest side, None if it does not fit
+    def best_fit(self, width, height):
+        best = None
+        for fx, fy, fw, fh in self.free:
+            if width <= fw and height <= fh:
+                score = (min(fw - width, fh - height),
+                         max(fw - width, fh - height))
+                if best is None or score < best[0]:
+                    best = (score, fx, fy)
+        return best
+
+    def place(self, x, y, width, height):
+        free = []
+        for rect in self.free:
+            free.extend(split_free_rect(rect, x, y, width, height))
+        # Remove the free rectangles contained in another one (and the
+        # duplicates)
+        self.free = [rect for i, rect in enumerate(free)
+                     if not any(rect_contains(other, rect) and
+                                (other != rect or j < i)
+                                for j, other in enumerate(free) if j != i)]
+        self.used_width = max(self.used_width, x + width)
+        self.used_height = max(self.used_height, y + height)
+
+# Parts of the free rectangle around the placed rectangle (x, y, w, h)
+def split_free_rect(rect, x, y, w, h):
+    fx, fy, fw, fh = rect
+    if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+        return [rect]
+    parts = []
+    if x > fx:
+        parts.append((fx, fy, x - fx, fh))
+    if x + w < fx + fw:
+        parts.append((x + w, fy, fx + fw - x - w, fh))
+    if y > fy:
+        parts.append((fx, fy, fw, y - fy))
+    if y + h < fy + fh:
+        parts.append((fx, y + h, fw, fy + fh - y - h))
+    return parts
+
+def rect_contains(rect, other):
+    return rect[0] <= other[0] and rect[1] <= other[1] and \
+        other[0] + other[2] <= rect[0] + rect[2] and \
+        other[1] + other[3] <= rect[1] + rect[3]
+
+# Pack (key, width, height) rectangles in bins of bin_width x bin_height,
+# the tallest first. Return {key: (bin index, x, y)} and the bins.
+def pack_rectangles(rectangles, bin_width, bin_height):
+    bins = []
+    positions = dict()
+    for key, width, height in sorted(rectangles,
+                                     key=lambda r: (-r[2], -r[1], r[0])):
+        if width > bin_width or height > bin_height:
+            raise ValueError("{} is bigger than the atlas size".format(key))
+        fits = [(fit, i) for i, fit in
+                enumerate(b.best_fit(width, height) for b in bins) if fit]
+        if not fits:
+            bins.append(MaxRectsBin(bin_width, bin_height))
+            fits = [(bins[-1].best_fit(width, height), len(bins) - 1)]
+        (_, x, y), i = min(fits)
+        bins[i].place(x, y, width, height)
+        positions[key] = (i, x, y)
+    return positions, bins
+
+def sprite_hash(items, width, height):
+    geometry = repr((width, height, [(item.color, item.points)
+                                     for item in items]))
+    return hashlib.sha1(geometry.encode()).hexdigest()
+
+def atlas_filename(index):
+    return "atlas_{}.png".format(index)
+
+def read_atlas_index(directory):
+    try:
+        with open(os.path.join(directory, ATLAS_INDEX_FILENAME)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+# Sprites pixels of a previous build: {hash: pixels}, for the wanted hashes
+# (the sprites of unreadable atlases are rasterized again)
+def previous_sprites(directory, index, hashes):
+    sprites = dict()
+    if index is None:
+        return sprites
+    by_atlas = collections.defaultdict(list)
+    for sprite in index['sprites']:
+        if sprite['hash'] in hashes:
+            by_atlas[sprite['atlas']].append(sprite)
+    for atlas, atlas_sprites in by_atlas.items():
+        try:
+            with open(os.path.join(directory,
+                                   index['atlases'][atlas]['filename']),
+                      'rb') as fh:
+                atlas_width, _, pixels = decode_png(fh.read())
+        except (OSError, ValueError, IndexError, zlib.error, struct.error):
+            continue
+        for sprite in atlas_sprites:
+            sprites[sprite['hash']] = copy_pixels(
+                pixels, atlas_width, sprite['x'], sprite['y'],
+                sprite['width'], sprite['height'])
+    return sprites
+
+# Pixels of the (x, y, width, height) area of an image
+def copy_pixels(pixels, image_width, x, y, width, height):
+    area = bytearray()
+    for row in range(y, y + height):
+        start = (row * image_width + x) * 3
+        area += pixels[start:start + width * 3]
+    return area
+
+def paste_pixels(pixels, image_width, x, y, width, area):
+    for row in range(len(area) // (width * 3)):
+        start = ((y + row) * image_width + x) * 3
+        pixels[start:start + width * 3] = \
+            area[row * width * 3:(row + 1) * width * 3]
+
+# Build the atlases of all the flags at the given widths in directory
+# (atlas_<n>.png files & the json index), reusing the sprites of the
+# previous build which did not change. Return the index.
+def build_atlas(directory, sizes=None, padding=ATLAS_PADDING,
+                max_size=ATLAS_MAX_SIZE):
+    sizes = sizes or DEFAULT_ATLAS_SIZES
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    sprites = []
+    for width in sizes:
+        for func, flag in flags_dict.items():
+            height = int(round(width * flag.ratio))
+            items = flag.record(0, 0, width, height)
+            sprites.append({'flag': func.__name__,
+                            'country_code': flag.country_code,
+                            'alpha2': flag_index.codes(flag)[0],
+                            'width': width, 'height': height,
+                            'hash': sprite_hash(items, width, height),
+                            'items': items})
+    # Atlases about square: the bin width is the side of the square with
+    # the sprites area (the atlases are cropped to their sprites)
+    area = sum((s['width'] + padding) * (s['height'] + padding)
+               for s in sprites)
+    bin_width = min(max_size, max(int(math.ceil(math.sqrt(area))),
+                                  max(sizes) + padding))
+    positions, bins = pack_rectangles(
+        [(i, s['width'] + padding, s['height'] + padding)
+         for i, s in enumerate(sprites)], bin_width, max_size)
+    previous = read_atlas_index(directory)
+    reused = previous_sprites(directory, previous,
+                              set(s['hash'] for s in sprites))
+    atlases = [bytearray(b'\xff' * (3 * b.used_width * b.used_height))
+               for b in bins]
+    rendered = 0
+    for i, sprite in enumerate(sprites):
+        atlas, x, y = positions[i]
+        sprite.update(atlas=atlas, x=x, y=y)
+        width, height = sprite['width'], sprite['height']
+        pixels = reused.get(sprite['hash'])
+        if pixels is None:
+            pixels = rasterize(sprite['items'], 0, 0, width, height,
+                               width, height)
+            rendered += 1
+        paste_pixels(atlases[atlas], bins[atlas].used_width, x, y, width,
+                     pixels)
+        del sprite['items']
+    index = {'sizes': sizes, 'padding': padding, 'atlases': [],
+             'sprites': sprites}
+    for i, (b, pixels) in enumerate(zip(bins, atlases)):
+        write_png(os.path.join(directory, atlas_filename(i)),
+                  b.used_width, b.used_height, pixels)
+        index['atlases'].append({'filename': atlas_filename(i),
+                                 'width': b.used_width,
+                                 'height': b.used_height})
+    # Remove the atlases of the previous build which are not used anymore
+    if previous is not None:
+        for atlas in previous['atlases'][len(bins):]:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(directory, atlas['filename']))
+    with open(os.path.join(directory, ATLAS_INDEX_FILENAME), 'w') as fh:
+        json.dump(index, fh, indent=1)
+    debug("Atlas:", len(sprites), "sprites in", len(bins), "atlases,",
+          rendered, "rasterized, in {:.3f}s".format(
+              time.perf_counter() - start))
+    index['rendered'] = rendered
+    return index
+
+
+### FLAGS HTTP SERVICE ###
+
+# Local http service rendering the flags on demand:
+#   /flag/<code>.<png|svg>?w=<width>  flag image, the code is any key of
+#                                     flag_index.lookup() (250, FR, fra...)
+#   /stats                            latency & throughput report (json)
+# Rendered images are kept in a LRU cache keyed by (country code, width,
+# format) with their ETag (If-None-Match requests get a 304 answer).
+# Images are rendered by a pool of processes, concurrent requests of the
+# same image wait for the same rendering.
+SERVE_CONTENT_TYPES = {'png': "image/png", 'svg': "image/svg+xml"}
+
+# Render a flag image in a worker process, return its data, ETag & the
+# rendering duration
+def render_flag(func_name, width, file_format):
+    start = time.perf_counter()
+    flag = flags_by_func_name()[func_name]
+    if file_format == 'svg':
+        data = svg_document(flag, width).encode('utf-8')
+    else:
+        data = render_png(flag, width)
+    etag = '"{}"'.format(hashlib.sha1(data).hexdigest()[:20])
+    return data, etag, time.perf_counter() - start
+
+# Ctrl+C stops the service, which stops its workers
+def ignore_interrupts():
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Latency (in milliseconds) statistics of a list of durations (in seconds)
+def latency_report(durations):
+    durations = list(durations)
+    return {'mean': round(1000 * sum(durations) / max(1, len(durations)), 3),
+            'p50': round(1000 * percentile(durations, 0.5), 3),
+            'p90': round(1000 * percentile(durations, 0.9), 3),
+            'p99': round(1000 * percentile(durations, 0.99), 3),
+            'max': round(1000 * max(durations, default=0), 3)}
+
+class ServiceStats(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.bytes = 0
+        self.statuses = collections.Counter()
+        self.cache = collections.Counter()  # hit, miss & coalesced counts
+        self.latencies = collections.deque(maxlen=SERVE_LATENCIES_KEPT)
+        self.render_seconds = 0
+        self._lock = threading.Lock()
+
+    def add_request(self, status, size, duration):
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.statuses[status] += 1
+            self.latencies.append(duration)
+
+    def add_cache(self, result):
+        with self._lock:
+            self.cache[result] += 1
+
+    def add_render(self, duration):
+        with self._lock:
+            self.render_seconds += duration
+
+    def report(self):
+        with self._lock:
+            uptime = time.perf_counter() - self.start
+            renders = self.cache['miss']
+            return {'uptime': round(uptime, 3), 'requests': self.requests,
+                    'requests_per_second': round(self.requests / uptime, 3),
+                    'bytes': self.bytes,
+                    'statuses': {str(status): count for status, count
+                                 in sorted(self.statuses.items())},
+                    'latency_ms': latency_report(self.latencies),
+                    'cache': dict(self.cache),
+                    'render_ms': round(1000 * self.render_seconds /
+                                       max(1, renders), 3)}
+
+class FlagService(object):
+    def __init__(self, jobs=None, cache_size=SERVE_CACHE_SIZE):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache_size = cache_size
+        # {(country code, width, format): future of (data, ETag)}, the
+        # futures of the renderings in progress are shared by their requests
+        self.responses = collections.OrderedDict()
+        self.stats = ServiceStats()
+        self.executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        import concurrent.futures
+        import multiprocessing
+        ensure_compiled_cache([SERVE_DEFAULT_WIDTH])
+        # Spawned workers: forking a process with server threads is unsafe
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.jobs, mp_context=multiprocessing.get_context("spawn"),
+            initializer=ignore_interrupts)
+        # Start the workers (they import this module) before the requests
+        concurrent.futures.wait([self.executor.submit(int)
+                                 for _ in range(self.jobs)])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    # Rendered flag image (data, ETag), from the cache if possible
+    def image(self, flag, width, file_format):
+        key = (flag.country_code, width, file_format)
+        rendering = False
+        with self._lock:
+            future = self.responses.get(key)
+            if future is None:
+                self.stats.add_cache('miss')
+                rendering = True
+                future = self.executor.submit(
+                    render_flag, flag.drawing_func.__name__, width,
+                    file_format)
+                self.responses[key] = future
+                while len(self.responses) > self.cache_size:
+                    self.responses.popitem(last=False)  # Least recently used
+            else:
+                self.stats.add_cache('hit' if future.done() else 'coalesced')
+                self.responses.move_to_end(key)
+        try:
+            data, etag, duration = future.result()
+        except Exception:
+            with self._lock:  # Do not keep the failed renderings
+                if self.responses.get(key) is future:
+                    del self.responses[key]
+            raise
+        if rendering:
+            self.stats.add_render(duration)
+        return data, etag
+
+    # Answer a GET request: return (status, headers, body)
+    def handle(self, path, if_none_match=None):
+        import urllib.parse
+        url = urllib.parse.urlsplit(path)
+        path = urllib.parse.unquote(url.path)
+        if path == "/stats":
+            body = json.dumps(self.stats.report(), indent=1).encode()
+            return 200, {'Content-Type': "application/json"}, body
+        flag = None
+        if path.startswith("/flag/"):
+            name, _, file_format = path[len("/flag/"):].rpartition(".")
+            if name and file_format in SERVE_CONTENT_TYPES:
+                flag = flag_index.lookup(name)
+        if flag is None:
+            return 404, {'Content-Type': "text/plain"}, b"Not found\n"
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            width = int(query.get('w', [SERVE_DEFAULT_WIDTH])[0])
+        except ValueError:
+            width = 0
+        if not 0 < width <= SERVE_MAX_WIDTH:
+            return 400, {'Content-Type': "text/plain"}, \
+                "Width must be in 1..{}\n".format(SERVE_MAX_WIDTH).encode()
+        data, etag = self.image(flag, width, file_format)
+        # The images only change with a new version of the service: clients
+        # revalidate them with their ETag
+        headers = {'ETag': etag, 'Cache-Control': "no-cache"}
+        tags = [tag.strip() for tag in (if_none_match or "").split(",")]
+        if "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag
+                                   for tag in tags]:
+            return 304, headers, b""
+        headers['Content-Type'] = SERVE_CONTENT_TYPES[file_format]
+        return 200, headers, data
+
+def flag_request_handler():
+    import http.server
+    class FlagRequestHandler(http.server.BaseHTTPRequestHandler):
+        server_version = "CountryFlags/1.0"
+        protocol_version = "HTTP/1.1"  # Keep the connections alive
+        # The headers & the body are sent separately: without this, the
+        # answers of kept alive connections wait for delayed ACKs (~40 ms)
+        disable_nagle_algorithm = True
+
+        def do_GET(self, send_body=True):
+            start = time.perf_counter()
+            service = self.server.service
+            try:
+                status, headers, body = service.handle(
+                    self.path, self.headers.get('If-None-Match'))
+            except Exception as e:
+                status, headers, body = 500, {'Content-Type': "text/plain"}, \
+                    "{}\n".format(e).encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            service.stats.add_request(status, len(body) if send_body else 0,
+                                      time.perf_counter() - start)
+
+        def do_HEAD(self):
+            self.do_GET(send_body=False)
+
+        def log_message(self, format, *args):
+            debug(self.address_string(), format % args)
+    return FlagRequestHandler
+
+# Http server of a started FlagService (a thread per connection)
+def flag_server(service, address=SERVE_ADDRESS, port=SERVE_PORT):
+    import http.server
+    server = http.server.ThreadingHTTPServer((address, port),
+                                             flag_request_handler())
+    server.service = service
+    return server
+
+# Run the service until Ctrl+C, then print its statistics report
+def serve(address=SERVE_ADDRESS, port=SERVE_PORT, jobs=None):
+    service = FlagService(jobs)
+    service.start()
+    server = flag_server(service, address, port)
+    print("Serving flags on http://{}:{}/flag/<code>.<png|svg>?w=<width>"
+          .format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    print(json.dumps(service.stats.report(), indent=1))
+
+
+### BENCHMARKS ###
+
+# Startup benchmark: run in fresh python processes the import of this module
+# and the drawing of a first flag (headless, encoded in memory to png) and
+# report the timings (median of "runs" runs) in seconds.
+STARTUP_BENCHMARK_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import country_flags as cf
+imported = time.perf_counter()
+flag = next(iter(cf.flags_dict.values()))
+w, h = 160, int(round(160 * flag.ratio))
+cf.encode_png(w, h, cf.rasterize(flag.record(0, 0, w, h), 0, 0, w, h, w, h))
+drawn = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_flag': drawn - start,
+                  'tk_imported': 'tkinter' in sys.modules}))
+"""
+
+def benchmark_startup(runs=5):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_BENCHMARK_CODE],
+                                cwd=directory, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output)
+        result['process'] = time.perf_counter() - start
+        results.append(result)
+    report = {'runs': runs,
+              'tk_imported': any(r['tk_imported'] for r in results)}
+    for key in ('import', 'first_flag', 'process'):
+        values = sorted(r[key] for r in results)
+        report[key] = round(values[len(values) // 2], 6)
+    return report
+
+# Per flag rendering benchmark: every flag is drawn at every size with every
+# available backend:
+# - record: the flag drawing function with a Recorder (python drawing code),
+# - compiled: the cached compiled flag (affine transform, level of detail),
+# - raster: headless png rendering (compiled flag + rasterizer + png),
+# - turtle & canvas: fast mode drawing on the screen (display needed).
+# Results are returned as a json compatible dictionary, to be compared
+# between revisions.
+BENCHMARK_BACKENDS = ("record", "compiled", "raster", "turtle", "canvas")
+
+def display_available():
+    try:
+        screen.instance()
+    except Exception: # No display, no tkinter...
+        return False
+    return True
+
+def benchmark_flag(flag, width, backend):
+    height = width * flag.ratio
+    result = {'flag': flag.drawing_func.__name__, 'backend': backend,
+              'width': width, 'turtle_ops': {}, 'canvas_items': 0}
+    if backend == "record":
+        counter = OperationCounter(Recorder())
+        with using_turtle(counter):
+            start = time.perf_counter()
+            flag.drawing_func(0, 0, width, height)
+            duration = time.perf_counter() - start
+        items = counter.target.items
+        result['turtle_ops'] = dict(counter.counts)
+    elif backend in ("compiled", "raster"):
+        flag.record(0, 0, width, height)  # Warm up the geometry cache
+        start = time.perf_counter()
+        items = flag.record(0, 0, width, height)
+        if backend == "raster":
+            w, h = int(round(width)), int(round(height))
+            encode_png(w, h, rasterize(items, 0, 0, width, height, w, h))
+        duration = time.perf_counter() - start
+    else:
+        items = flag.record(-width / 2, height / 2, width, height)
+        canvas = screen.getcanvas()
+        clear_drawings()
+        items_before = len(canvas.find_all())
+        counter = OperationCounter(ct.instance())
+        with using_turtle(counter):
+            start = time.perf_counter()
+            draw_display_list(items, backend)
+            screen.update()
+            duration = time.perf_counter() - start
+        result['turtle_ops'] = dict(counter.counts)
+        result['canvas_items'] = len(canvas.find_all()) - items_before
+        clear_drawings()
+    result['seconds'] = duration
+    result['shapes'] = len(items)
+    result['vertices'] = sum(len(item.points) for item in items)
+    result['turtle_ops_total'] = sum(result['turtle_ops'].values())
+    return result
+
+def benchmark_flags(sizes=None, backends=None, repeat=DEFAULT_BENCHMARK_REPEAT):
+    sizes = sizes or DEFAULT_BENCHMARK_SIZES
+    backends = list(backends or BENCHMARK_BACKENDS)
+    skipped = []
+    if any(b in ("turtle", "canvas") for b in backends) and \
+       not display_available():
+        skipped = [b for b in backends if b in ("turtle", "canvas")]
+        backends = [b for b in backends if b not in skipped]
+    if "turtle" in backends or "canvas" in backends:
+        update_configure(True)
+    results = []
+    for flag in flags_dict.values():
+        for width in sizes:
+            for backend in backends:
+                runs = [benchmark_flag(flag, width, backend)
+                        for _ in range(repeat)]
+                best = min(runs, key=lambda r: r['seconds'])
+                best['seconds'] = round(best['seconds'], 6)
+                results.append(best)
+    return {'source_sha1': source_hash(), 'python': sys.version.split()[0],
+            'numpy': bool(import_numpy()) and USE_NUMPY,
+            'sizes': sizes, 'backends': backends, 'skipped_backends': skipped,
+            'repeat': repeat, 'results': results}
+
+# Http service benchmark: a FlagService is started on a free port and
+# "clients" threads request the png images of all the flags at the given
+# widths: each image is requested twice at the same time with an empty
+# cache (cold, the renderings are coalesced), then again (warm, from the
+# cache) and with its ETag (revalidate, 304 answers). Report the latency &
+# the throughput of each phase (client side) and the service statistics.
+def benchmark_service(sizes=None, clients=8, jobs=None):
+    import concurrent.futures
+    import http.client
+    sizes = sizes or DEFAULT_BENCHMARK_SIZES
+    service = FlagService(jobs)
+    service.start()
+    server = flag_server(service, SERVE_ADDRESS, 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    connections = threading.local()  # One connection per client thread
+    etags = dict()
+
+    def request(path, revalidate):
+        if not hasattr(connections, 'connection'):
+            connections.connection = http.client.HTTPConnection(
+                SERVE_ADDRESS, port)
+        headers = {'If-None-Match': etags[path]} if revalidate else {}
+        start = time.perf_counter()
+        connections.connection.request("GET", path, headers=headers)
+        response = connections.connection.getresponse()
+        response.read()
+        etags[path] = response.getheader('ETag')
+        return time.perf_counter() - start, response.status
+
+    paths = ["/flag/{}.png?w={}".format(flag.country_code, width)
+             for width in sizes for flag in flags_dict.values()]
+    phases = (("cold", [path for path in paths for _ in range(2)], False),
+              ("warm", paths, False), ("revalidate", paths, True))
+    report = {'clients': clients, 'jobs': service.jobs, 'sizes': sizes,
+              'phases': {}}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+            for phase, phase_paths, revalidate in phases:
+                start = time.perf_counter()
+                results = list(executor.map(request, phase_paths,
+                                            [revalidate] * len(phase_paths)))
+                duration = time.perf_counter() - start
+                report['phases'][phase] = {
+                    'requests': len(results), 'seconds': round(duration, 6),
+                    'requests_per_second': round(len(results) / duration, 3),
+                    'statuses': dict(collections.Counter(
+                        str(status) for _, status in results)),
+                    'latency_ms': latency_report(d for d, _ in results)}
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+    report['service'] = service.stats.report()
+    return report
+
+# Hash of this source file, to identify the revision of benchmark results
+def source_hash():
+    with open(os.path.abspath(__file__), 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
 
 
 ### MAIN ###
 
-def main():
+# Load country names according to the language
+def load_locale_country_names():
+    # Note: below commented lines are for debugging languages
+    #locale.setlocale(locale.LC_ALL, "en_US.utf8")
+    #locale.setlocale(locale.LC_ALL, "fr_FR.utf8")
+    #locale.setlocale(locale.LC_ALL, "it_IT.utf8")
+    #locale.setlocale(locale.LC_ALL, "de_DE.utf8")
+    loc = locale.getdefaultlocale()
+    # convert "en_US" to "en"
+    language = (loc[0] or DEFAULT_LANGUAGE).split("_", 1)[0]
+    #print(loc[0], language)
+
+    if not load_country_names(language):
+        if not load_country_names(DEFAULT_LANGUAGE):
+            print("No country name files found!")
+        else:
+            print("Use default \"" + DEFAULT_LANGUAGE + "\" language")
+
+def main(mode="all"):
+    if DEBUG:
+        enable_profiling()
+
     # Black border, red inside
     ct.color('black', 'red')
     # Pen thickness
@@ -863,47 +4210,29 @@ def main():
 
     if USE_ALWAYS_VISIBLE_TURTLE_SHAPE:
         # Only compound shape supports colors
+        from turtle import Shape
         s = Shape("compound")
         s.addcomponent(ct.get_shapepoly(), "white", "black")
         screen.register_shape("always_visible_shape", s)
         ct.shape("always_visible_shape")
 
-    update_configure(DEFAULT_FAST_DRAW, DEFAULT_ANIMATION_SPEED)
+    update_configure(DEFAULT_FAST_DRAW, DEFAULT_ANIMATION_SPEED,
+                     DEFAULT_DRAW_BACKEND)
 
     install_event_management()
 
-    # Load country names according to the language
-    # Note: below commented lines are for debugging languages
-    #locale.setlocale(locale.LC_ALL, "en_US.utf8")
-    #locale.setlocale(locale.LC_ALL, "fr_FR.utf8")
-    #locale.setlocale(locale.LC_ALL, "it_IT.utf8")
-    #locale.setlocale(locale.LC_ALL, "de_DE.utf8")
-    loc = locale.getdefaultlocale()
-    language = loc[0].split("_", 1)[0]  # convert "en_US" to "en"
-    #print(loc[0], language)
-
-    if not load_country_names(language):
-        if not load_country_names(DEFAULT_LANGUAGE):
-            print("No country name files found!")
-        else:
-            print("Use default \"" + DEFAULT_LANGUAGE + "\" language")
+    load_locale_country_names()
 
     if DEBUG:
         print("\nCountry list in country code order:")
-        for key, value in flags_dict.items():
-            print("{:03d}".format(value.country_code),
-                  get_country_name(value.country_code))
+        for flag in flag_index.sorted_by_code():
+            print("{:03d}".format(flag.country_code),
+                  get_country_name(flag.country_code))
 
         print("\nCountry list in alphabetical order:")
-        # Make a copy before modifying it
-        tmp_flags_dict = flags_dict.copy()
-        # Flag dict alphabetical sort thanks to a lambda function
-        sorted(tmp_flags_dict.items(), key=lambda x:
-               strip_accents(get_country_name(x[1].country_code)))
-        for key, value in tmp_flags_dict.items():
-            print(get_country_name(value.country_code) + "(" +
-                  "{:03d}".format(value.country_code) + ")")
-        del tmp_flags_dict
+        for flag in flag_index.sorted_by_name():
+            print(get_country_name(flag.country_code) + "(" +
+                  "{:03d}".format(flag.country_code) + ")")
 
         print("\nThere are already " + str(len(flags_dict)) +
               " flags, great job!\n")
@@ -913,14 +4242,133 @@ def main():
     #test_flag_class(flag_United_States, False)
     #test_flag_class(flag_France, True)
     #screenshot("flag_France")
-    draw_all_flags(160, 60, country_names=True, ratio=False)
+    # Draw the flags from the event loop, so the window stays responsive
+    if mode == "pages":
+        start_gallery(PagedGallery(flags_dict.values(), 160, 60))
+    elif mode == "scroll":
+        start_gallery(ScrollingGallery(flag_index.sorted_by_name(), 60))
+    else:
+        render_in_background(draw_all_flags_steps(160, 60, country_names=True,
+                                                  ratio=False))
     #screenshot_all()
     #test_screenshot_anim(flag_South_Korea)
 
     update_do()
     return "Ready"
 
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Draw country flags with "
+                                     "the Python Turtle.")
+    parser.add_argument("--mode", choices=("all", "pages", "scroll"),
+                        default="all",
+                        help="all flags at once, page by page (arrow keys) "
+                        "or scrolling (default %(default)s)")
+    parser.add_argument("--export", metavar="DIR",
+                        help="export all flags in DIR (no display needed) "
+                        "instead of drawing them")
+    parser.add_argument("--atlas", metavar="DIR",
+                        help="pack all flags in sprite atlases (png) with a "
+                        "json index in DIR, only the changed flags are "
+                        "drawn again")
+    parser.add_argument("--catalogue", metavar="FILE",
+                        help="write all the flags in a pdf or postscript "
+                        "document (FILE.pdf or FILE.ps), one flag per page")
+    parser.add_argument("--sizes", default=None,
+                        type=lambda s: [int(w) for w in s.split(",")],
+                        help="comma separated flag widths in pixels "
+                        "(default {} for --export, {} for --atlas, {} for "
+                        "--benchmark)".format(DEFAULT_EXPORT_SIZES,
+                                              DEFAULT_ATLAS_SIZES,
+                                              DEFAULT_BENCHMARK_SIZES))
+    parser.add_argument("--formats", default=DEFAULT_EXPORT_FORMATS,
+                        type=lambda s: s.split(","),
+                        help="comma separated export formats among " +
+                        ", ".join(sorted(export_formats)) +
+                        " (default %(default)s)")
+    parser.add_argument("--jobs", "-j", type=int, default=None, metavar="N",
+                        help="number of export processes (default: number "
+                        "of cpus)")
+    parser.add_argument("--serve", action="store_true",
+                        help="serve the flags images over http, rendered "
+                        "on demand: /flag/<code>.<png|svg>?w=<width>")
+    parser.add_argument("--port", type=int, default=SERVE_PORT,
+                        help="http service port (default %(default)s)")
+    parser.add_argument("--benchmark", metavar="FILE",
+                        help="benchmark the drawing of every flag and write "
+                        "the results as json in FILE ('-' for stdout)")
+    parser.add_argument("--backends", default=None,
+                        type=lambda s: s.split(","),
+                        help="comma separated benchmark backends among " +
+                        ", ".join(BENCHMARK_BACKENDS) + " (default: all "
+                        "the available ones)")
+    parser.add_argument("--check-optimization", action="store_true",
+                        help="check that the shapes optimization gives the "
+                        "same pixels for every flag")
+    parser.add_argument("--build-cache", action="store_true",
+                        help="add the flags of the --sizes widths to the "
+                        "compiled flags cache file ({}), rebuilt if it is out "
+                        "of date".format(COMPILED_CACHE_FILENAME))
+    parser.add_argument("--debug", action="store_true",
+                        help="print debug messages and profile the turtle "
+                        "calls (a profile is printed on exit)")
+    parser.add_argument("--benchmark-service", action="store_true",
+                        help="measure the latency & throughput of the http "
+                        "service and print them as json")
+    parser.add_argument("--benchmark-startup", action="store_true",
+                        help="measure the import time & the time to the "
+                        "first flag and print them as json")
+    return parser.parse_args(argv)
+
+# Command line entry point
+def cli(argv=None):
+    global DEBUG
+    args = parse_arguments(argv)
+    if args.debug:
+        DEBUG = True
+    if args.check_optimization:
+        differences = check_optimization()
+        for (name, width), count in sorted(differences.items()):
+            if count:
+                print(name, width, "px:", count, "different pixels")
+        print("Optimization check", "failed" if any(differences.values())
+              else "passed")
+    elif args.build_cache:
+        if ensure_compiled_cache(args.sizes):
+            print("Compiled flags cache up to date")
+        else:
+            print("Compiled flags cache could not be written")
+    elif args.benchmark_startup:
+        print(json.dumps(benchmark_startup(), indent=1))
+    elif args.benchmark_service:
+        print(json.dumps(benchmark_service(args.sizes, jobs=args.jobs),
+                         indent=1))
+    elif args.serve:
+        load_locale_country_names()
+        serve(port=args.port, jobs=args.jobs)
+    elif args.benchmark:
+        report = json.dumps(benchmark_flags(args.sizes, args.backends),
+                            indent=1)
+        if args.benchmark == "-":
+            print(report)
+        else:
+            with open(args.benchmark, 'w') as fh:
+                fh.write(report)
+    elif args.catalogue:
+        load_locale_country_names()
+        write_catalogue(args.catalogue)
+    elif args.atlas:
+        index = build_atlas(args.atlas, args.sizes)
+        print("{} sprites in {} atlases ({} drawn)".format(
+            len(index['sprites']), len(index['atlases']), index['rendered']))
+    elif args.export:
+        manifest = batch_export(args.export, args.sizes, args.formats,
+                                args.jobs)
+        print("Exported {} files in {:.2f}s".format(len(manifest['files']),
+                                                    manifest['seconds']))
+    else:
+        msg = main(args.mode)
+        print(msg)
+        screen.mainloop()
+
 if __name__ == "__main__":
-    msg = main()
-    print(msg)
-    mainloop()
+    cli()